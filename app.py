@@ -5,7 +5,8 @@ from flask.json import dumps
 from flask.cli import with_appcontext
 from flask_cors import CORS, cross_origin
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import or_
+from sqlalchemy import tuple_
+from sqlalchemy.exc import IntegrityError
 from flask_migrate import Migrate
 from marshmallow import fields, Schema
 from json import dumps as json_dumps
@@ -17,6 +18,9 @@ import os, sys
 
 from src.utils.auth import *
 from src.utils.api_utils import *
+from src.utils.cache import change_listener, track_table_changes
+from src.utils.heartbeat_buffer import HeartbeatBuffer
+from src.utils.presence import PresenceIndex
 
 load_dotenv()
 
@@ -29,6 +33,12 @@ migrate.init_app(app)
 
 CORS(app)
 
+# Decode the caller's token once per request; see src/utils/auth.py
+app.before_request(load_auth_context)
+
+# Cross-worker cache invalidation; see src/utils/cache.py
+change_listener.init_app(app)
+
 # TODO(phil): when uncommented, this gives the error:
 #   "The default Firebase app already exists."
 firebase = firebase_admin.initialize_app()
@@ -46,6 +56,9 @@ app.register_blueprint(online_mode_api)
 # Import models
 from src.models import *
 
+# Lets per-worker caches depend on tables; see src/utils/cache.py
+track_table_changes(db.session)
+
 """
 Auth
 
@@ -61,6 +74,7 @@ https://stackoverflow.com/questions/44899658/how-to-authenticate-an-user-in-fire
     Class Sections
 """
 @app.route('/classes', methods=['GET'])
+@conditional(['class_section'], verify=verify_admin)
 def classes():
     try:
         verify_admin()
@@ -76,8 +90,7 @@ def classes():
             else:
                 return error(404, 'Class not found')
         
-        classes = ClassSection.query.all()
-        return jsonify([c.serialize() for c in classes])
+        return list_response(ClassSection.query)
     except Exception as e:
         return error(error=e)
         
@@ -203,8 +216,7 @@ def get_students():
             except Exception as e:
                 return error(403, error=e)
                 
-            students = ClassSectionStudent.query.all()
-            return jsonify([s.serialize() for s in students])
+            return list_response(ClassSectionStudent.query)
     except Exception as e:
         print(str(e))
         return error(error=e)
@@ -273,7 +285,7 @@ def get_class_section_students(class_id):
                 return jsonify(student.serialize())
         
         students = ClassSectionStudent.query.filter_by(class_section_id=class_id)
-        return jsonify([s.serialize() for s in students])
+        return list_response(students)
     except Exception as e:
         return error(error=e)
 
@@ -310,6 +322,24 @@ def create_students(class_id):
         return error(error=e)
 
 
+def _flush_heartbeats(entries):
+    with app.app_context():
+        StudentHeartbeat.record_batch(entries)
+
+
+heartbeat_buffer = HeartbeatBuffer(
+    _flush_heartbeats,
+    interval=app.config['HEARTBEAT_FLUSH_INTERVAL'],
+    max_size=app.config['HEARTBEAT_FLUSH_SIZE']
+)
+
+presence_index = PresenceIndex(
+    StudentHeartbeat.latest_since,
+    ttl=app.config['PRESENCE_TTL'],
+    refresh_interval=app.config['PRESENCE_REFRESH_INTERVAL']
+)
+
+
 @app.route('/students/<int:student_id>/heartbeat', methods=['POST'])
 def student_heartbeat(student_id):
     try:
@@ -318,40 +348,45 @@ def student_heartbeat(student_id):
         return error(403, error=e)
     
     try:
-        student = ClassSectionStudent.query.get(student_id)
-        if student is None:
-            return error(404, message='This student does not exist')
-
         json = request.get_json()
         device_id = json.get('device_id')
         if device_id is None:
             raise ValueError('Must provide a device ID')
 
-        prev_heartbeat = StudentHeartbeat.query \
-            .filter_by(student_id=student_id) \
-            .filter_by(device_id=device_id) \
-            .order_by(StudentHeartbeat.last_updated.desc()) \
-            .first()
-        
-        skill = json.get('skill')
-        if prev_heartbeat is None or prev_heartbeat.skill != skill:
-            heartbeat = StudentHeartbeat(
-                student_id=student_id,
-                device_id=device_id,
-                skill=json.get('skill')
-            )
-            db.session.add(heartbeat)
-            db.session.commit()
+        class_id = presence_index.class_for(student_id)
+        if class_id is None:
+            student = ClassSectionStudent.query.get(student_id)
+            if student is None:
+                return error(404, message='This student does not exist')
+            class_id = student.class_section_id
+
+        # Written to student_heartbeat in the background (see HeartbeatBuffer)
+        heartbeat = heartbeat_buffer.add(student_id, device_id, json.get('skill'))
+        presence_index.record(
+            student_id,
+            class_id,
+            device_id,
+            heartbeat['skill'],
+            heartbeat['last_seen']
+        )
+        return jsonify({
+            'student_id': heartbeat['student_id'],
+            'skill': heartbeat['skill'],
+            'time': heartbeat['last_seen']
+        }), 202
+    except Exception as e:
+        return error(error=e)
 
-            print('New heartbeat:')
-            print(heartbeat.serialize())
 
-            return jsonify(heartbeat.serialize())
-        else:
-            prev_heartbeat.repeat()
-            db.session.commit()
-            print('Updating previous heartbeat')
-            return jsonify(prev_heartbeat.serialize())
+@app.route('/classes/<int:class_id>/online-students', methods=['GET'])
+def get_online_students(class_id):
+    try:
+        verify_admin()
+    except Exception as e:
+        return error(403, error=e)
+
+    try:
+        return jsonify(presence_index.online(class_id, request.args.get('skill')))
     except Exception as e:
         return error(error=e)
 
@@ -447,7 +482,7 @@ def find_guide(student_id):
     except Exception as e:
         return error(403, error=e)
 
-    student = ClassSectionStudent.query.get(student_id)
+    student = current_auth().student_for(student_id)
     if student is None:
         return error(404, message='This student does not exist.')
 
@@ -464,25 +499,20 @@ def find_guide(student_id):
 
 def _find_guides(student_id, class_id, skill):
     query = """
-        select distinct s.* from 
-            class_section_student s,
-            (
-                select * from ka_skill_completion
-                    where
-                        skill = '%s'
-                    and (
-                        mastery_category = 'mastered' 
-                        or mastery_category = 'proficient'
-                        or questions_correct = questions_out_of
-                    )
-            ) as c
+        select s.* from
+            student_skill_mastery m,
+            class_section_student s
         where
-            s.id != %d
-            and s.class_section_id = %d
-            and s.id = c.student_id
-    """ % (skill.lower(), student_id, class_id)
-
-    return db.session.execute(query)
+            m.class_section_id = :class_id
+            and m.skill = :skill
+            and m.student_id != :student_id
+            and s.id = m.student_id
+    """
+    return db.session.execute(query, {
+        'class_id': class_id,
+        'skill': skill.lower(),
+        'student_id': student_id
+    })
 
 
 """
@@ -538,9 +568,13 @@ def create_multi_ka_skill_completion_by_name():
     
     {
         unrecognized_students: string[],
-        completions: completion[]
+        completions: completion[],
+        errors: {student_name: string, index: number, message: string}[]
     }
     
+    Completions that fail validation are reported in 'errors' (by student name and
+    position in that student's list) and skipped; the rest are still inserted.
+    
     This is intended for use with the teacher dashboard.
     """
     try:
@@ -550,29 +584,76 @@ def create_multi_ka_skill_completion_by_name():
     
     try:
         json = request.get_json()
-        new_completions = []
-        unrecognized_students = []
+
+        # Resolve every name at once (the first student with a name wins, as before)
+        student_ids = {}
+        students = db.session.query(ClassSectionStudent.name, ClassSectionStudent.id) \
+            .filter(ClassSectionStudent.name.in_(list(json.keys()))) \
+            .order_by(ClassSectionStudent.id)
+        for name, student_id in students:
+            student_ids.setdefault(name, student_id)
+
+        unrecognized_students = [name for name in json if name not in student_ids]
+
+        rows = []
+        errors = []
         for name, completions in json.items():
-            student = ClassSectionStudent.query.filter_by(name=name).first()
-            if student is None:
-                unrecognized_students.append(name)
+            if name not in student_ids:
                 continue
-            
-            for completion_dict in completions:
-                completion_dict['student_id'] = student.id
-                completion = _completion_from_dict(completion_dict)
-                new_completions.append(completion)
-        
-        db.session.add_all(new_completions)
+
+            for index, completion_dict in enumerate(completions):
+                message = _completion_error(completion_dict)
+                if message is not None:
+                    errors.append({'student_name': name, 'index': index, 'message': message})
+                else:
+                    rows.append(_completion_row(student_ids[name], completion_dict))
+
+        new_completions = KASkillCompletion.bulk_insert(rows)
+        KASkillCompletion.update_projections([c['id'] for c in new_completions])
         db.session.commit()
         return jsonify({
-            'completions': [c.serialize() for c in new_completions],
-            'unrecognized_students': unrecognized_students
+            'completions': new_completions,
+            'unrecognized_students': unrecognized_students,
+            'errors': errors
         })
     except Exception as e:
         return error(error=e)
 
 
+def _completion_error(d):
+    if not isinstance(d, dict):
+        return 'Must provide a completion object.'
+
+    skill = d.get('skill')
+    if not isinstance(skill, str) or skill == '':
+        return 'Must provide a skill.'
+
+    if d.get('recorded_from') not in KASkillCompletionSource.__members__:
+        return 'Invalid recorded_from: %s' % d.get('recorded_from')
+
+    for key in ['questions_correct', 'questions_out_of', 'mastery_points', 'mastery_points_out_of']:
+        value = d.get(key)
+        if value is not None and (not isinstance(value, int) or isinstance(value, bool)):
+            return '%s must be an integer.' % key
+
+    return None
+
+
+def _completion_row(student_id, d):
+    return {
+        'student_id': student_id,
+        'course': d.get('course'),
+        'unit': d.get('unit'),
+        'skill': d.get('skill').lower(),
+        'questions_correct': d.get('questions_correct'),
+        'questions_out_of': d.get('questions_out_of'),
+        'mastery_category': d.get('mastery_category'),
+        'mastery_points': d.get('mastery_points'),
+        'mastery_points_out_of': d.get('mastery_points_out_of'),
+        'recorded_from': d.get('recorded_from')
+    }
+
+
 def _completion_from_dict(d):
     return KASkillCompletion(
         student_id=d.get('student_id'),
@@ -597,7 +678,7 @@ def get_ka_skill_completions_for_student(student_id):
     
     try:
         completions = KASkillCompletion.query.filter_by(student_id=student_id)
-        return jsonify([c.serialize() for c in completions])
+        return list_response(completions)
     except Exception as e:
         return error(error=e)
     
@@ -612,15 +693,66 @@ def get_ka_skill_completions():
     try:
         start_time = request.args.get('start_time')
         if start_time is not None:
-            time = datetime.datetime.utcfromtimestamp(int(start_time))
+            time = datetime.datetime.utcfromtimestamp(float(start_time))
             completions = KASkillCompletion.query.filter(KASkillCompletion.created_at >= time)
-            return jsonify([c.serialize() for c in completions])
+            return list_response(completions)
         
-        return jsonify([c.serialize() for c in KASkillCompletion.query.all()])
+        return list_response(KASkillCompletion.query)
     except Exception as e:
         return error(error=e)
     
 
+@app.route('/ka-skill-completion/changes', methods=['GET'])
+def get_ka_skill_completion_changes():
+    """
+    Change feed for the dashboard. Returns up to 'limit' completions after the
+    opaque 'cursor' from the previous call (or from the beginning):
+    
+    {
+        completions: completion[],
+        cursor: string,
+        has_more: boolean
+    }
+    
+    Completions are ordered by the ID of the transaction that inserted them,
+    and only those of transactions older than every transaction still in
+    progress are handed out. Anything committed later therefore sorts after
+    the returned cursor, however long its transaction ran or whatever the
+    clocks said; pass the cursor back as-is to get only what has been added
+    since.
+    """
+    try:
+        verify_admin()
+    except Exception as e:
+        return error(403, error=e)
+
+    try:
+        keys = [KASkillCompletion.txid, KASkillCompletion.id]
+        limit = parse_limit(request.args.get('limit'), default=500)
+        settled = db.session.execute('select txid_snapshot_xmin(txid_current_snapshot())').scalar()
+
+        query = KASkillCompletion.query.filter(KASkillCompletion.txid < settled)
+        cursor = request.args.get('cursor')
+        if cursor is not None:
+            values = decode_cursor(cursor, keys)
+            if not all(isinstance(v, int) for v in values):
+                raise ValueError('Invalid cursor')
+            query = query.filter(tuple_(*keys) > tuple_(*values))
+
+        completions = query.order_by(*keys).limit(limit).all()
+        if len(completions) > 0:
+            last = completions[-1]
+            cursor = encode_cursor([last.txid, last.id])
+
+        return jsonify({
+            'completions': [c.serialize() for c in completions],
+            'cursor': cursor,
+            'has_more': len(completions) == limit
+        })
+    except Exception as e:
+        return error(error=e)
+
+
 @app.route('/ka-skill-completion/<int:id>', methods=['GET'])
 def get_ka_skill_completion(id):
     try:
@@ -646,7 +778,7 @@ def create_ka_skill_completion_for_student(student_id):
         return error(403, error=e)
 
     try:
-        student = ClassSectionStudent.query.get(student_id)
+        student = current_auth().student_for(student_id)
         if student is None:
             return error(404, message='This student does not exist.')
 
@@ -659,13 +791,14 @@ def create_ka_skill_completion_for_student(student_id):
 
         response_data = {}
         if completion.is_struggling():
-            result = find_matches(student, 'e4n', {'skill': completion.skill})
-            response_data['guides'] = [dict(r) for r in result]
+            guides, _ = find_matches(student, 'e4n', {'skill': completion.skill})
+            response_data['guides'] = guides
 
-        online_mode = OnlineMode.get()
-        response_data['is_online'] = online_mode.is_online
+        response_data['is_online'] = OnlineMode.is_online_cached()
 
         db.session.add(completion)
+        db.session.flush()
+        KASkillCompletion.update_projections([completion.id])
         db.session.commit()
         response_data['completion'] = completion.serialize()
         return jsonify(response_data)
@@ -689,44 +822,43 @@ def create_tutoring_session():
         guide_id = json.get('guide_id')
         if guide_id is None:
             raise ValueError('Must provide a guide')
+        guide_id = int(guide_id)
         
         learner_id = json.get('learner_id')
         if learner_id is None:
             raise ValueError('Must provide a learner')
+        learner_id = int(learner_id)
 
         guide = ClassSectionStudent.query.get(guide_id)
         if guide is None:
             raise ValueError('This guide does not exist')
 
-        # Check if the learner or guide is currently in a session
-        # ERROR MESSAGES ASSUME THE SESSION IS ALWAYS CREATED BY THE LEARNER
-        learner_session = TutoringSession.query \
-            .filter(TutoringSession.end_time.is_(None)) \
-            .filter(or_(TutoringSession.learner_id == learner_id, TutoringSession.guide_id == learner_id)) \
-            .first()
-        if learner_session is not None:
-            raise ValueError('You are already in a session. Please refresh.')
-
-        guide_session = TutoringSession.query \
-            .filter(TutoringSession.end_time.is_(None)) \
-            .filter(or_(TutoringSession.learner_id == guide_id, TutoringSession.guide_id == guide_id)) \
-            .first()
-        if guide_session is not None:
-            raise ValueError('Guide is already in a session. Please select another guide.')
-
         skill = json.get('skill')
         if skill is None:
             raise ValueError('Must provide a skill')
 
-        learner = ClassSectionStudent.query.get(learner_id)
+        learner = current_auth().student_for(learner_id)
         if learner is None:
             raise ValueError('This learner does not exist')
 
-        is_online = OnlineMode.get().is_online
+        # Read before taking the locks below: on a cache miss this may commit
+        # the default online_mode row, which would release them
+        is_online = OnlineMode.is_online_cached()
         conference_link = json.get('conference_link')
         if is_online and (conference_link is None or conference_link == ''):
             raise ValueError('Must provide a conference link.')
 
+        # Held until commit, so concurrent requests for either student wait
+        # here and then see this session; the partial unique indexes on open
+        # sessions back this up.
+        # ERROR MESSAGES ASSUME THE SESSION IS ALWAYS CREATED BY THE LEARNER
+        TutoringSession.lock_students([learner_id, guide_id])
+        busy = TutoringSession.busy_students([learner_id, guide_id])
+        if learner_id in busy:
+            raise ValueError('You are already in a session. Please refresh.')
+        if guide_id in busy:
+            raise ValueError('Guide is already in a session. Please select another guide.')
+
         session = TutoringSession(
             guide_id=guide_id,
             learner_id=learner_id,
@@ -736,7 +868,13 @@ def create_tutoring_session():
             conference_link=conference_link
         )
         db.session.add(session)
-        db.session.commit()
+        try:
+            session.activate()
+            db.session.commit()
+        except IntegrityError:
+            # Only reachable if something bypassed the advisory locks
+            db.session.rollback()
+            raise ValueError('Learner or guide is already in a session. Please refresh.')
         return jsonify(session.serialize())
     except Exception as e:
         return error(error=e)
@@ -750,8 +888,7 @@ def get_all_tutoring_sessions():
         return error(403, error=e)
 
     try:
-        sessions = TutoringSession.query.all()
-        return jsonify([s.serialize() for s in sessions])
+        return list_response(TutoringSession.query)
     except Exception as e:
         return error(error=e)
 
@@ -781,15 +918,11 @@ def get_current_student_tutoring_session(student_id):
         return error(403, error=e)
 
     try:
-        session = TutoringSession.query \
-            .filter_by(learner_id=student_id) \
-            .filter(TutoringSession.end_time.is_(None)) \
-            .first()
-
-        if session is None:
+        current = ActiveTutoringSession.lookup(student_id, 'learner')
+        if current is None:
             return ('', 204)
-        
-        guide = ClassSectionStudent.query.get(session.guide_id)
+
+        session, guide = current
         return jsonify({
             'guide': guide.serialize(),
             'session': session.serialize()
@@ -806,17 +939,14 @@ def get_current_guide_online_session(student_id):
         return error(403, error=e)
     
     try:
-        session = TutoringSession.query \
-            .filter_by(guide_id=student_id) \
-            .filter(TutoringSession.end_time.is_(None)) \
-            .filter(TutoringSession.conference_link.isnot(None)) \
-            .filter_by(request_status=SessionRequestStatus.accepted) \
-            .first()
+        current = ActiveTutoringSession.lookup(student_id, 'guide')
+        if current is None:
+            return ('', 204)
 
-        if session is None:
+        session, learner = current
+        if session.conference_link is None or session.request_status != SessionRequestStatus.accepted:
             return ('', 204)
-        
-        learner = ClassSectionStudent.query.get(session.learner_id)
+
         return jsonify({
             'learner': learner.serialize(),
             'session': session.serialize()
@@ -833,15 +963,14 @@ def get_pending_sessions_for_guide(student_id):
         return error(403, error=e)
     
     try:
-        session = TutoringSession.query \
-            .filter_by(guide_id=student_id) \
-            .filter_by(request_status='pending') \
-            .first()
+        current = ActiveTutoringSession.lookup(student_id, 'guide')
+        if current is None:
+            return ('', 204)
 
-        if session is None:
+        session, learner = current
+        if session.request_status != SessionRequestStatus.pending:
             return ('', 204)
 
-        learner = ClassSectionStudent.query.get(session.learner_id)
         return jsonify({
             'learner': learner.serialize(),
             'session': session.serialize()
@@ -851,6 +980,7 @@ def get_pending_sessions_for_guide(student_id):
 
 
 @app.route('/tutoring-sessions/cancellation-reasons', methods=['GET'])
+@conditional(verify=verify_user)
 def get_cancellation_reasons():
     try:
         verify_user()
@@ -965,21 +1095,18 @@ def get_completion_before_session(session_id):
         if session is None:
             return error(404, message='This session does not exist.')
 
-        query = """
-            select * from ka_skill_completion
-            where 
-                created_at < '%s'
-                and skill = '%s'
-                and (recorded_from = 'unit_view_task' or recorded_from = 'lesson_view_task')
-            order by created_at desc
-            limit 1
-        """ % (session.start_time, session.skill)
-
-        result = db.session.execute(query).first()
-        if result is None:
+        gain = SessionLearningGain.query.get(session_id)
+        if gain is not None:
+            # Computed once the session ended; nothing new can show up before it
+            completion = KASkillCompletion.query.get(gain.before_completion_id) \
+                if gain.before_completion_id is not None else None
+        else:
+            completion = KASkillCompletion.nearest_task(session.learner_id, session.skill, session.start_time, before=True)
+
+        if completion is None:
             return ('', 204)
         else:
-            return jsonify(dict(result))
+            return jsonify(completion.serialize())
     except Exception as e:
         return error(error=e)
 
@@ -996,22 +1123,68 @@ def get_completion_after_session(session_id):
         if session is None:
             return error(404, message='This session does not exist.')
 
-        date = session.end_time if session.end_time else session.start_time
-        query = """
-            select * from ka_skill_completion
-            where 
-                created_at > '%s'
-                and skill = '%s'
-                and (recorded_from = 'unit_view_task' or recorded_from = 'lesson_view_task')
-            order by created_at asc
-            limit 1
-        """ % (date, session.skill)
-
-        result = db.session.execute(query).first()
-        if result is None:
+        gain = SessionLearningGain.query.get(session_id)
+        if gain is not None and gain.after_completion_id is not None:
+            completion = KASkillCompletion.query.get(gain.after_completion_id)
+        else:
+            # Not computed yet, or the learner hadn't practiced the skill since
+            date = session.end_time if session.end_time else session.start_time
+            completion = KASkillCompletion.nearest_task(session.learner_id, session.skill, date, before=False)
+
+        if completion is None:
             return ('', 204)
         else:
-            return jsonify(dict(result))
+            return jsonify(completion.serialize())
+    except Exception as e:
+        return error(error=e)
+
+
+@app.route('/tutoring-sessions/learning-gains', methods=['GET'])
+def get_learning_gains():
+    try:
+        verify_admin()
+    except Exception as e:
+        return error(403, error=e)
+
+    try:
+        return list_response(SessionLearningGain.query)
+    except Exception as e:
+        return error(error=e)
+
+
+@app.route('/tutoring-sessions/<int:session_id>/learning-gain', methods=['GET'])
+def get_learning_gain(session_id):
+    try:
+        verify_admin()
+    except Exception as e:
+        return error(403, error=e)
+
+    try:
+        gain = SessionLearningGain.query.get(session_id)
+        if gain is None:
+            return error(404, message='No learning gain has been computed for this session.')
+
+        return jsonify(gain.serialize())
+    except Exception as e:
+        return error(error=e)
+
+
+@app.route('/tutoring-sessions/learning-gains', methods=['POST'])
+def compute_learning_gains():
+    """
+    Fills session_learning_gain for ended sessions; pass {"recompute": true}
+    to redo sessions that already have both completions
+    """
+    try:
+        verify_admin()
+    except Exception as e:
+        return error(403, error=e)
+
+    try:
+        json = request.get_json(silent=True) or {}
+        count = SessionLearningGain.compute(bool(json.get('recompute')))
+        db.session.commit()
+        return jsonify({'computed': count})
     except Exception as e:
         return error(error=e)
 
@@ -1024,17 +1197,18 @@ def get_tutoring_sessions_for_class(class_id):
         return error(403, error=e)
     
     try:
-        query = """
-            select distinct t.* from
-                class_section_student s,
-                tutoring_session t,
-                class_section c
-            where
-                t.guide_id = s.id 
-                and s.class_section_id = c.id 
-        """
-        result = db.session.execute(query)
-        return jsonify([dict(r) for r in result])
+        # Optional filters: since/until (unix timestamps on start_time) and
+        # status ('active', 'ended' or a request status)
+        since = request.args.get('since')
+        if since is not None:
+            since = datetime.datetime.utcfromtimestamp(float(since))
+
+        until = request.args.get('until')
+        if until is not None:
+            until = datetime.datetime.utcfromtimestamp(float(until))
+
+        sessions = TutoringSession.for_class(class_id, since, until, request.args.get('status'))
+        return list_response(sessions)
     except Exception as e:
         return error(error=e)
 
@@ -1050,7 +1224,7 @@ def get_sessions_for_student(student_id):
         sessions = TutoringSession.query.filter(
             (TutoringSession.guide_id == student_id) | (TutoringSession.learner_id == student_id)
         )
-        return jsonify([s.serialize() for s in sessions])
+        return list_response(sessions)
     except Exception as e:
         return error(error=e)
 
@@ -1066,15 +1240,8 @@ def get_skills_for_class(class_id):
         return error(403, error=e)
     
     try:
-        query = """
-            select distinct skill from
-                ka_skill_completion c,
-                class_section_student s
-            where
-                c.student_id = s.id
-                and s.class_section_id = %d
-        """ % (class_id)
-        result = db.session.execute(query)
-        return jsonify([r[0] for r in result])
+        # ?sort=recent (latest completion first) or active (most completions)
+        skills = ClassSkill.for_class(class_id, request.args.get('sort'))
+        return jsonify([r[0] for r in skills])
     except Exception as e:
         return error(error=e)
\ No newline at end of file
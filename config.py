@@ -6,6 +6,20 @@ basedir = os.path.abspath(os.path.dirname(__file__))
 class Config(object):
   SQLALCHEMY_DATABASE_URI = os.environ['DATABASE_URL']
 
+  # Heartbeats are written in batches; see src/utils/heartbeat_buffer.py
+  HEARTBEAT_FLUSH_INTERVAL = float(os.environ.get('HEARTBEAT_FLUSH_INTERVAL', 5))
+  HEARTBEAT_FLUSH_SIZE = int(os.environ.get('HEARTBEAT_FLUSH_SIZE', 500))
+
+  # Seconds after their last heartbeat that students stop counting as online
+  PRESENCE_TTL = int(os.environ.get('PRESENCE_TTL', 60))
+  PRESENCE_REFRESH_INTERVAL = int(os.environ.get('PRESENCE_REFRESH_INTERVAL', 15))
+
+  # Upper bound on how stale a worker's caches can get if it misses a NOTIFY
+  CACHE_TTL = int(os.environ.get('CACHE_TTL', 30))
+
+  # Part of every ETag, so that a deploy invalidates what clients have cached
+  APP_VERSION = os.environ.get('APP_VERSION', os.environ.get('HEROKU_SLUG_COMMIT', ''))
+
 class ProductionConfig(Config):
   DEVELOPMENT = False
 
@@ -11,5 +11,48 @@ manager = Manager(app)
 
 manager.add_command('db', MigrateCommand)
 
+
+@manager.option('-s', '--sizes', dest='sizes', default='10000,100000,1000000')
+def bench_lists(sizes):
+    """Times the admin list endpoints at the given table sizes"""
+    from src.benchmarks import bench_list_endpoints
+    bench_list_endpoints([int(size) for size in sizes.split(',')])
+
+
+@manager.option('-c', '--class-sizes', dest='class_sizes', default='30,300,3000')
+@manager.option('-t', '--totals', dest='totals', default='10000,100000,1000000')
+def bench_class_sessions(class_sizes, totals):
+    """Times the class tutoring session listing against class size and total sessions"""
+    from src.benchmarks import bench_class_sessions
+    bench_class_sessions(
+        [int(size) for size in class_sizes.split(',')],
+        [int(total) for total in totals.split(',')]
+    )
+
+
+@manager.option('-r', '--recompute', dest='recompute', action='store_true', default=False)
+@manager.option('-w', '--window-days', dest='window_days', type=int, default=14)
+def compute_learning_gains(recompute, window_days):
+    """Fills session_learning_gain for ended tutoring sessions"""
+    from src.models import SessionLearningGain
+    count = SessionLearningGain.compute(recompute, window_days)
+    db.session.commit()
+    print('Computed %d learning gains' % count)
+
+
+@manager.option('-a', '--algorithm', dest='algorithm_id', type=int, required=True)
+@manager.option('-s', '--students', dest='student_ids', default=None)
+@manager.option('-c', '--class', dest='class_id', type=int, default=None)
+@manager.option('-r', '--runs', dest='runs', type=int, default=10)
+@manager.option('--compare', dest='compare_to', type=int, default=None)
+@manager.option('--args', dest='raw_args', default='{}')
+def bench_algorithm(algorithm_id, student_ids, class_id, runs, compare_to, raw_args):
+    """Profiles a matching algorithm: latency percentiles, rows and EXPLAIN plan"""
+    import json
+    from src.benchmarks import bench_algorithm
+    if student_ids is not None:
+        student_ids = [int(student_id) for student_id in student_ids.split(',')]
+    bench_algorithm(algorithm_id, student_ids, class_id, json.loads(raw_args), runs, compare_to)
+
 if __name__ == '__main__':
     manager.run()
\ No newline at end of file
@@ -4,14 +4,20 @@ from flask import Blueprint, jsonify, request
 
 from ..utils.api_utils import *
 from ..utils.auth import *
+from ..utils.cache import InvalidatingCache
 from ..models import *
 
 form_api = Blueprint('form_api', __name__)
 
+# (class ID, date) => the /forms/current payload, or None if there's no form
+CURRENT_FORM_TABLES = ['form', 'form_question', 'form_distribution', 'question', 'question_label', 'label']
+current_forms = InvalidatingCache('current_forms', tables=CURRENT_FORM_TABLES)
+
 """
   Questions
 """
 @form_api.route('/question-types', methods=['GET'])
+@conditional(verify=verify_admin)
 def get_question_types():
   try:
     verify_admin()
@@ -32,14 +38,11 @@ def get_questions():
     arg_num_responses = request.args.get('num_responses')
     include_num_responses = arg_num_responses is None or arg_num_responses == 'true'
 
-    questions = Question.query.all()
-
-    question_data = []
-    for question in questions:
-      data = question.serialize(include_num_responses)
-      question_data.append(data)
-
-    return jsonify(question_data)
+    counts = QuestionResponseCount.counts() if include_num_responses else {}
+    return list_response(
+      Question.query,
+      lambda q: q.serialize(include_num_responses, counts.get(q.id, 0))
+    )
   except Exception as e:
     return error(error=e)
 
@@ -123,14 +126,14 @@ def get_forms():
     return error(403, error=e)
   
   try:
-    forms = Form.query.all()
-    return jsonify([f.serialize() for f in forms])
+    return list_response(Form.query)
   except Exception as e:
     return error(error=e)
 
 
 # Date should be formatted yyyy-mm-dd
 @form_api.route('/forms/current', methods=['GET'])
+@conditional(CURRENT_FORM_TABLES, verify=verify_user)
 def get_current_form():
   try: 
     verify_user()
@@ -146,34 +149,11 @@ def get_current_form():
     if date is None:
       raise ValueError('Must provide a date')
 
-    distribution = FormDistribution.query \
-      .filter_by(applicable_date=date) \
-      .filter_by(class_section_id=int(class_id)) \
-      .first()
-
-    if distribution is None:
+    payload = current_forms.get((int(class_id), date), _load_current_form)
+    if payload is None:
       return ('', 204)
 
-    form = Form.query.get(distribution.form_id)
-
-    form_questions = FormQuestion.query \
-      .filter_by(form_id=form.id) \
-      .filter(FormQuestion.archived_at.is_(None)) \
-      .order_by(FormQuestion.index_in_form)
-    
-    questions = [
-      {
-        'form_question': fq.serialize(), 
-        'question': Question.query.get(fq.question_id).serialize()
-      }
-      for fq in form_questions
-    ]
-
-    return jsonify({
-      'distribution': distribution.serialize(),
-      'form': form.serialize(),
-      'questions': questions 
-    })
+    return jsonify(payload)
   except Exception as e:
     return error(error=e)
 
@@ -229,8 +209,7 @@ def get_form_questions():
     return error(403, error=e)
   
   try:
-    form_questions = FormQuestion.query.all()
-    return jsonify([fq.serialize() for fq in form_questions])
+    return list_response(FormQuestion.query)
   except Exception as e:
     return error(error=e)
 
@@ -270,7 +249,7 @@ def get_form_questions_for_form(form_id):
 
   try:
     form_questions = FormQuestion.query.filter_by(form_id=form_id)
-    return jsonify([fq.serialize() for fq in form_questions])
+    return list_response(form_questions)
   except Exception as e:
     return error(error=e)
 
@@ -285,7 +264,7 @@ def create_form_question():
   try:
     json = request.get_json()
     form_id, question_id = get_values(json, ['form_id', 'question_id'])
-    form = Form.query.get(form_id)
+    form = Form.lock(form_id)
     if form is None:
       raise ValueError('Form %d does not exist' % form_id)
 
@@ -320,46 +299,54 @@ def update_form_question_index(form_question_id):
     if index is None:
       raise ValueError('Must provide a new index')
 
-    form = Form.query.get(form_question.form_id)
-    if index >= form.num_questions(): # Max index
-      index = form.num_questions() - 1
+    # Concurrent reorders of the same form wait for each other
+    Form.lock(form_question.form_id)
+    ids = FormQuestion.ordered_ids(form_question.form_id)
+    index = max(0, min(index, len(ids) - 1))
 
-    if index < 0: # Min index
-      index = 0
+    ids.remove(form_question.id)
+    ids.insert(index, form_question.id)
+    updated_questions = FormQuestion.apply_order(form_question.form_id, ids)
+    db.session.commit()
 
-    old_index = form_question.index_in_form
-    if old_index == index:
+    if len(updated_questions) == 0:
       return jsonify([form_question.serialize()])
+    return jsonify(updated_questions)
+  except Exception as e:
+    return error(error=e)
 
-    updated_questions = [form_question]
-    if index < old_index:
-      # Moving it DOWN; move indices between new and old index UP
-      questions = FormQuestion.query \
-        .filter_by(form_id=form_question.form_id) \
-        .filter(FormQuestion.index_in_form >= index) \
-        .filter(FormQuestion.index_in_form < old_index)
-
-      for question in questions:
-        question.index_in_form += 1
-        updated_questions.append(question)
-    else:
-      # Moving it UP; move indices between new and old index DOWN
-      questions = FormQuestion.query \
-        .filter_by(form_id=form_question.form_id) \
-        .filter(FormQuestion.index_in_form <= index) \
-        .filter(FormQuestion.index_in_form > old_index)
-      
-      for question in questions:
-        question.index_in_form -= 1
-        updated_questions.append(question)
+  
+@form_api.route('/forms/<int:form_id>/form-questions/order', methods=['POST'])
+def update_form_question_order(form_id):
+  """
+  Applies a full ordering in one go; expects 'form_question_ids' to list every
+  form question of the form (archived ones included) in their new order.
+  Returns the form questions whose index changed.
+  """
+  try:
+    verify_admin()
+  except Exception as e:
+    return error(403, error=e)
+
+  try:
+    json = request.get_json()
+    ids = get_values(json, ['form_question_ids'])
+
+    form = Form.lock(form_id)
+    if form is None:
+      return error(404, message='This form does not exist')
 
-    form_question.index_in_form = index
+    current_ids = FormQuestion.ordered_ids(form_id)
+    if len(ids) != len(current_ids) or set(ids) != set(current_ids):
+      raise ValueError('Must list every form question of form %d exactly once' % form_id)
+
+    updated_questions = FormQuestion.apply_order(form_id, ids)
     db.session.commit()
-    return jsonify([fq.serialize() for fq in updated_questions])
+    return jsonify(updated_questions)
   except Exception as e:
     return error(error=e)
 
-  
+
 @form_api.route('/forms/<int:form_id>/create-question', methods=['POST'])
 def create_question_for_form(form_id):
   try:
@@ -373,7 +360,7 @@ def create_question_for_form(form_id):
     db.session.add(question)
     db.session.commit()
 
-    form = Form.query.get(form_id)
+    form = Form.lock(form_id)
     if form is None:
       return error(404, message='This form does not exist')
 
@@ -408,8 +395,7 @@ def get_distributions():
     return error(403, error=e)
   
   try:
-    distributions = FormDistribution.query.all()
-    return jsonify([d.serialize() for d in distributions])
+    return list_response(FormDistribution.query, serialize_rows=_serialize_distributions)
   except Exception as e:
     return error(error=e)
 
@@ -484,11 +470,17 @@ def get_distributions_for_form(form_id):
   
   try:
     distributions = FormDistribution.query.filter_by(form_id=form_id)
-    return jsonify([d.serialize() for d in distributions])
+    return list_response(distributions, serialize_rows=_serialize_distributions)
   except Exception as e:
     return error(error=e)
 
 
+def _serialize_distributions(distributions):
+  # Counts responses for just the distributions being returned
+  counts = FormDistribution.response_counts([d.id for d in distributions])
+  return [d.serialize(num_responses=counts.get(d.id, 0)) for d in distributions]
+
+
 """
   Form Responses
 """
@@ -501,7 +493,7 @@ def get_responses_for_session(session_id):
 
   try:
     responses = FormResponse.query.filter_by(session_id=session_id)
-    return jsonify([r.serialize() for r in responses])
+    return list_response(responses)
   except Exception as e:
     return error(error=e)
 
@@ -515,7 +507,7 @@ def get_responses_for_distribution(distribution_id):
   
   try:
     responses = FormResponse.query.filter_by(form_distribution_id=distribution_id)
-    return jsonify([r.serialize() for r in responses])
+    return list_response(responses)
   except Exception as e:
     return error(error=e)
 
@@ -536,37 +528,50 @@ def create_responses_for_distribution():
     if distribution is None:
       raise ValueError('No distribution found for this ID')
 
+    form_questions = {
+      fq.id: fq for fq in FormQuestion.query.filter_by(form_id=distribution.form_id)
+    }
+    answers = {int(form_question_id): response for form_question_id, response in responses.items()}
+
     # Check that all required questions are answered
-    required_questions = FormQuestion.query \
-      .filter_by(form_id=distribution.form_id) \
-      .filter(FormQuestion.archived_at.is_(None)) \
-      .filter_by(required=True)
-    for required_question in required_questions:
-      if str(required_question.id) not in responses:
-        raise ValueError('Must answer question %s' % required_question.id)
-
-    # Create FormResponse objects
-    form_responses = []
-    for form_question_id, response in responses.items():
-      form_question = FormQuestion.query.get(form_question_id)
-
-      # Make sure this question is part of this distribution
-      if form_question.form_id != distribution.form_id:
-        raise ValueError('Form question %d is not part of distribution %d' % (form_question_id, distribution_id))
-      
-      response = FormResponse(
-        form_question_id=form_question_id,
-        form_distribution_id=distribution_id,
-        class_section_student_id=student_id,
-        session_id=session_id,
-        original_question_index=form_question.index_in_form,
-        response=response
-      )
-      form_responses.append(response)
-
-    db.session.add_all(form_responses)
+    required = set(
+      fq.id for fq in form_questions.values()
+      if fq.required and fq.archived_at is None
+    )
+    missing = required - set(answers)
+    if len(missing) > 0:
+      raise ValueError('Must answer question %s' % min(missing))
+
+    # Make sure every question is part of this distribution
+    unknown = set(answers) - set(form_questions)
+    if len(unknown) > 0:
+      raise ValueError('Form question %d is not part of distribution %d' % (min(unknown), distribution_id))
+
+    now = datetime.datetime.utcnow()
+    rows = [
+      {
+        'form_question_id': form_question_id,
+        'form_distribution_id': distribution_id,
+        'class_section_student_id': student_id,
+        'session_id': session_id,
+        'original_question_index': form_questions[form_question_id].index_in_form,
+        'response': response,
+        'created_at': now
+      }
+      for form_question_id, response in answers.items()
+    ]
+    saved = FormResponse.upsert_all(rows)
+
+    # Retried submissions update the existing rows; only new ones are counted
+    new_counts = {}
+    for row in saved:
+      if row['inserted']:
+        question_id = form_questions[row['form_question_id']].question_id
+        new_counts[question_id] = new_counts.get(question_id, 0) + 1
+    QuestionResponseCount.increment(new_counts)
+
     db.session.commit()
-    return jsonify([fr.serialize() for fr in form_responses])
+    return jsonify([FormResponse.serialize_row(row) for row in saved])
   except Exception as e:
     return error(error=e)
 
@@ -574,6 +579,57 @@ def create_responses_for_distribution():
 """
   Private Methods
 """
+def _load_current_form(key):
+  """
+  Loads the distribution, form and ordered questions (with their labels) for
+  a (class ID, date) in a single query
+  """
+  class_id, date = key
+  rows = db.session.query(FormDistribution, Form, FormQuestion, Question, Label) \
+    .join(Form, Form.id == FormDistribution.form_id) \
+    .outerjoin(FormQuestion, db.and_(
+      FormQuestion.form_id == Form.id,
+      FormQuestion.archived_at.is_(None)
+    )) \
+    .outerjoin(Question, Question.id == FormQuestion.question_id) \
+    .outerjoin(QuestionLabel, QuestionLabel.question_id == Question.id) \
+    .outerjoin(Label, Label.id == QuestionLabel.label_id) \
+    .filter(FormDistribution.applicable_date == date) \
+    .filter(FormDistribution.class_section_id == class_id) \
+    .order_by(FormQuestion.index_in_form, FormQuestion.id, Label.id) \
+    .all()
+
+  if len(rows) == 0:
+    return None
+
+  distribution, form = rows[0][0], rows[0][1]
+  questions = []
+  by_form_question = {}
+  for _, _, form_question, question, label in rows:
+    if form_question is None:
+      continue
+
+    entry = by_form_question.get(form_question.id)
+    if entry is None:
+      # Response counts change with every submission, so they aren't cached here
+      entry = {
+        'form_question': form_question.serialize(),
+        'question': question.serialize(include_num_responses=False),
+        'labels': []
+      }
+      by_form_question[form_question.id] = entry
+      questions.append(entry)
+
+    if label is not None:
+      entry['labels'].append(label.serialize())
+
+  return {
+    'distribution': distribution.serialize(include_num_responses=False),
+    'form': form.serialize(),
+    'questions': questions
+  }
+
+
 def get_question(json):
   question_text, question_type = get_values(json, ['question', 'question_type'])
   return Question(
@@ -4,10 +4,15 @@ from flask import Blueprint, jsonify, request
 
 from ..utils.api_utils import *
 from ..utils.auth import *
+from ..utils.cache import InvalidatingCache, notify
+from ..utils import query_profiler
 from ..models import *
 
 matching_api = Blueprint('matching_api', __name__)
 
+# Key => the MatchingAlgorithm currently active for it (detached from any session)
+active_algorithms = InvalidatingCache('matching_algorithms')
+
 """
   Algorithms
 """
@@ -19,8 +24,7 @@ def get_matching_algorithms():
     return error(403, error=e)
   
   try:
-    algorithms = MatchingAlgorithm.query.all()
-    return jsonify([a.serialize() for a in algorithms])
+    return list_response(MatchingAlgorithm.query)
   except Exception as e:
     return error(error=e)
 
@@ -41,9 +45,14 @@ def create_matching_algorithm():
       sql_query=query,
       args=json.get('args')
     )
+    algorithm.set_budgets(json)
     db.session.add(algorithm)
+    db.session.flush()
+
+    # Rejects the algorithm if it's over its cost budget
+    cost = algorithm.check_cost()
     db.session.commit()
-    return jsonify(algorithm.serialize())
+    return jsonify(dict(algorithm.serialize(), estimated_cost=cost))
   except Exception as e:
     return error(error=e)
 
@@ -71,15 +80,17 @@ def update_matching_algorithm(algorithm_id):
       alg.description = desc
 
     query = json.get('sql_query')
-    if query is not None:
-      alg.sql_query = query
-
     args = json.get('args')
-    if args is not None:
-      alg.args = args
+    if query is not None or args is not None:
+      alg.set_query(query, args)
 
+    alg.set_budgets(json)
+    cost = alg.check_cost()
+
+    notify(db.session, active_algorithms.topic)
     db.session.commit()
-    return jsonify(alg.serialize())
+    active_algorithms.clear()
+    return jsonify(dict(alg.serialize(), estimated_cost=cost))
   except Exception as e:
     return error(error=e)
 
@@ -123,7 +134,9 @@ def create_active_matching_algorithm():
     )
     db.session.add(active)
     currents.append(active.serialize())
+    notify(db.session, active_algorithms.topic)
     db.session.commit()
+    active_algorithms.clear()
     return jsonify(currents)
   except Exception as e:
     return error(error=e)
@@ -137,8 +150,7 @@ def get_active_matching_algorithms():
     return error(403, error=e)
   
   try:
-    actives = ActiveMatchingAlgorithm.query.all()
-    return jsonify([a.serialize() for a in actives])
+    return list_response(ActiveMatchingAlgorithm.query)
   except Exception as e:
     return error(error=e)
 
@@ -166,8 +178,11 @@ def get_matches_for_student(student_id):
     if algorithm is None:
       return error(404, message='This algorithm does not exist')
 
-    matches = _find_matches(student, algorithm, request.args)
-    return jsonify([dict(m) for m in matches])
+    matches, truncated = _find_matches(student, algorithm, request.args)
+    response = jsonify(matches)
+    if truncated:
+      response.headers['X-Matches-Truncated'] = str(algorithm.max_rows)
+    return response
   except Exception as e:
     return error(error=e)
 
@@ -180,13 +195,15 @@ def get_matches_for_student_with_active_algorithm(student_id, key):
     return error(403, error=e)
   
   try:
-    student = ClassSectionStudent.query.get(student_id)
+    student = current_auth().student_for(student_id)
     if student is None:
       return error(404, message='This student does not exist')
 
+    matches, truncated = find_matches(student, key, request.args)
     result = {
-      'matches': [dict(m) for m in find_matches(student, key, request.args)],
-      'is_online': OnlineMode.get().is_online
+      'matches': matches,
+      'truncated': truncated,
+      'is_online': OnlineMode.is_online_cached()
     }
     return result
   except Exception as e:
@@ -194,31 +211,112 @@ def get_matches_for_student_with_active_algorithm(student_id, key):
 
 
 def find_matches(student, key, reqArgs):
+  algorithm = active_algorithms.get(key, _load_active_algorithm)
+  if algorithm is None:
+    raise ValueError('No matching algorithm active for key %s' % key)
+
+  return _find_matches(student, algorithm, reqArgs)
+
+
+def _load_active_algorithm(key):
   active = ActiveMatchingAlgorithm.query \
     .filter_by(key=key) \
     .filter(ActiveMatchingAlgorithm.archived_at.is_(None)) \
     .first()
 
   if active is None:
-    raise ValueError('No matching algorithm active for key %s', key)
+    return None
 
   algorithm = MatchingAlgorithm.query.get(active.matching_algorithm_id)
-  return _find_matches(student, algorithm, reqArgs)
+  if algorithm is not None:
+    db.session.expunge(algorithm)
+  return algorithm
 
 
 def _find_matches(student, algorithm, reqArgs):
-  args = []
-  # Build arguments
-  for arg in algorithm.args:
-    if arg['type'] == 'field':
-      args.append(getattr(student, arg['field']))
-    elif arg['type'] == 'raw':
-      val = reqArgs.get(arg['field'])
-      if val is None:
-        raise ValueError('Must provide %s' % arg['field'])
-      else:
-        args.append(val)
-
-  # Return query results
-  query = algorithm.sql_query % tuple(args)
-  return db.session.execute(query)
\ No newline at end of file
+  args = algorithm.build_args(student, reqArgs)
+
+  # Return query results (and whether they hit the row budget)
+  return algorithm.execute(args)
+
+
+"""
+  Benchmarks
+"""
+# Students an algorithm is benchmarked for when given a class
+MAX_BENCHMARK_STUDENTS = 50
+
+MAX_BENCHMARK_RUNS = 100
+
+
+@matching_api.route('/matching-algorithms/<int:algorithm_id>/benchmark', methods=['POST'])
+def benchmark_matching_algorithm(algorithm_id):
+  """
+  Expects 'student_ids' or 'class_id' to pick the students, plus optional
+  'args' (values for the algorithm's raw arguments), 'runs' and 'compare_to'
+  (another algorithm ID to run on the same students)
+  """
+  try:
+    verify_admin()
+  except Exception as e:
+    return error(403, error=e)
+
+  try:
+    json = request.get_json()
+    algorithm = MatchingAlgorithm.query.get(algorithm_id)
+    if algorithm is None:
+      return error(404, message='This matching algorithm does not exist')
+
+    other = None
+    if json.get('compare_to') is not None:
+      other = MatchingAlgorithm.query.get(json['compare_to'])
+      if other is None:
+        return error(404, message='The algorithm to compare to does not exist')
+
+    students = benchmark_students(json.get('student_ids'), json.get('class_id'))
+    runs = max(1, min(int(json.get('runs', 10)), MAX_BENCHMARK_RUNS))
+    return jsonify(benchmark_algorithms(algorithm, other, students, json.get('args') or {}, runs))
+  except Exception as e:
+    db.session.rollback()
+    return error(error=e)
+
+
+def benchmark_students(student_ids=None, class_id=None):
+  if student_ids is not None:
+    students = ClassSectionStudent.query.filter(ClassSectionStudent.id.in_(student_ids)).all()
+  elif class_id is not None:
+    students = ClassSectionStudent.query \
+      .filter_by(class_section_id=class_id) \
+      .order_by(ClassSectionStudent.id) \
+      .limit(MAX_BENCHMARK_STUDENTS) \
+      .all()
+  else:
+    raise ValueError('Must provide student_ids or a class_id')
+
+  if len(students) == 0:
+    raise ValueError('No students to run the algorithm for')
+  return students
+
+
+def benchmark_algorithms(algorithm, other, students, raw_args, runs):
+  """
+  Profiles 'algorithm' (and 'other', if given) for the students; see
+  src/utils/query_profiler.py
+  """
+  result = {'algorithm': _benchmark(algorithm, students, raw_args, runs)}
+  if other is not None:
+    result['compare_to'] = _benchmark(other, students, raw_args, runs)
+  return result
+
+
+def _benchmark(algorithm, students, raw_args, runs):
+  arg_lists = [algorithm.build_args(student, raw_args) for student in students]
+  with algorithm.sandbox() as connection:
+    report = query_profiler.profile(connection, algorithm.compiled(), arg_lists, runs, algorithm.max_rows)
+  report.update({
+    'matching_algorithm_id': algorithm.id,
+    'name': algorithm.name,
+    'version': algorithm.version,
+    'students': len(students)
+  })
+  return report
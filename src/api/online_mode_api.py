@@ -23,12 +23,14 @@ def set_online_mode():
 
     OnlineMode.set_online(is_online)
     db.session.commit()
+    OnlineMode.cache.clear()
     return ('', 204)
   except Exception as e:
     return error(error=e)
 
 
 @online_mode_api.route('/online-mode', methods=['GET'])
+@conditional(['online_mode'], verify=verify_admin)
 def get_online_mode():
   try:
     verify_admin()
@@ -36,6 +38,6 @@ def get_online_mode():
     return error(403, error=e)
   
   try:
-    return jsonify(OnlineMode.get().serialize())
+    return jsonify({'is_online': OnlineMode.is_online_cached()})
   except Exception as e:
     return error(error=e)
\ No newline at end of file
@@ -0,0 +1,236 @@
+import json as json_lib
+import statistics
+import time
+
+from flask import jsonify
+
+from app import app
+from .models import *
+from .utils.api_utils import encode_cursor, list_response
+
+"""
+Benchmarks
+
+Run through manage.py against a scratch database: rows are seeded inside a
+transaction that is rolled back at the end, but 1M-row runs still take a
+while and a lot of WAL.
+"""
+
+RUNS = 5
+
+# Path => (query, serialize) as used by the list route
+LIST_ENDPOINTS = [
+  ('/students', lambda: ClassSectionStudent.query, None),
+  ('/tutoring-sessions', lambda: TutoringSession.query, None),
+  ('/ka-skill-completion', lambda: KASkillCompletion.query, None),
+  ('/questions', lambda: Question.query, lambda q: q.serialize(False)),
+  ('/forms', lambda: Form.query, None),
+]
+
+# Full (unpaginated) listings are only timed up to this many rows
+MAX_FULL_LIST_ROWS = 100000
+
+
+def bench_list_endpoints(sizes):
+  for size in sizes:
+    try:
+      seed_list_tables(size)
+      print('\n%d rows' % size)
+      print('%-24s %-32s %10s %10s' % ('endpoint', 'params', 'median ms', 'bytes'))
+
+      for path, query, serialize in LIST_ENDPOINTS:
+        model = query().column_descriptions[0]['entity']
+        max_id = db.session.query(db.func.max(model.id)).scalar() or 0
+        deep_cursor = encode_cursor([max(0, max_id - 100)])
+
+        cases = [
+          'limit=100',
+          'limit=100&after=%s' % deep_cursor,
+          'limit=100&fields=id',
+        ]
+        if size <= MAX_FULL_LIST_ROWS:
+          cases.append('')
+
+        if size <= MAX_FULL_LIST_ROWS:
+          ms, size_bytes = _time_unpaginated(query, serialize)
+          print('%-24s %-32s %10.1f %10d' % (path, '(before: all rows)', ms, size_bytes))
+
+        for params in cases:
+          ms, size_bytes = _time_list(path, params, query, serialize)
+          label = params.replace(deep_cursor, '<deep>') or '(all rows)'
+          print('%-24s %-32s %10.1f %10d' % (path, label, ms, size_bytes))
+    finally:
+      db.session.rollback()
+
+
+def seed_list_tables(size):
+  class_id = db.session.execute(
+    "insert into class_section (name) values ('benchmark') returning id"
+  ).scalar()
+
+  params = {'n': size, 'class_id': class_id}
+  db.session.execute("""
+    insert into class_section_student (name, email, class_section_id, created_at)
+    select 'Benchmark ' || g, 'benchmark-' || g || '@example.com', :class_id, now()
+    from generate_series(1, :n) g
+  """, params)
+
+  db.session.execute("""
+    insert into ka_skill_completion
+      (student_id, skill, questions_correct, questions_out_of, recorded_from, created_at)
+    select s.id, 'skill-' || (s.id % 50), 3, 4, 'unit_view', now()
+    from class_section_student s
+    where s.class_section_id = :class_id
+  """, params)
+
+  db.session.execute("""
+    insert into tutoring_session (guide_id, learner_id, skill, start_time, end_time, request_status)
+    select s.id, s.id, 'skill-' || (s.id % 50), now(), now(), 'not_applicable'
+    from class_section_student s
+    where s.class_section_id = :class_id
+  """, params)
+
+  db.session.execute("""
+    insert into question (question, question_type)
+    select 'Benchmark question ' || g, 'short_text'
+    from generate_series(1, :n) g
+  """, params)
+
+  db.session.execute("""
+    insert into form (name)
+    select 'Benchmark form ' || g
+    from generate_series(1, :n) g
+  """, params)
+
+  db.session.execute('analyze')
+
+
+def _time_list(path, params, query, serialize):
+  timings = []
+  size_bytes = 0
+  for _ in range(RUNS):
+    with app.test_request_context('%s?%s' % (path, params)):
+      start = time.perf_counter()
+      response = list_response(query(), serialize)
+      size_bytes = len(response.get_data())
+      timings.append((time.perf_counter() - start) * 1000)
+
+  return statistics.median(timings), size_bytes
+
+
+def _time_unpaginated(query, serialize):
+  """The list routes as they were before list_response: every row, unordered"""
+  serialize = serialize or (lambda row: row.serialize())
+  timings = []
+  size_bytes = 0
+  for _ in range(RUNS):
+    with app.test_request_context():
+      start = time.perf_counter()
+      response = jsonify([serialize(row) for row in query()])
+      size_bytes = len(response.get_data())
+      timings.append((time.perf_counter() - start) * 1000)
+
+  return statistics.median(timings), size_bytes
+
+
+def bench_class_sessions(class_sizes, totals):
+  """
+  Times /classes/<id>/tutoring-sessions for one class of each size while the
+  rest of the database holds 'total' sessions; the timings should follow the
+  class size and stay flat across totals.
+  """
+  print('%-12s %-12s %-24s %10s' % ('class size', 'total', 'params', 'median ms'))
+  for total in totals:
+    for class_size in class_sizes:
+      try:
+        class_id = seed_class_sessions(class_size, total)
+        query = lambda: TutoringSession.for_class(class_id)
+
+        for params in ['limit=100', '']:
+          ms, _ = _time_list('/classes/%d/tutoring-sessions' % class_id, params, query, None)
+          print('%-12d %-12d %-24s %10.1f' % (class_size, total, params or '(all rows)', ms))
+      finally:
+        db.session.rollback()
+
+
+def seed_class_sessions(class_size, total):
+  """
+  Seeds a class of 'class_size' students with one session each, plus
+  unrelated classes of 30 students holding the remaining sessions. Returns
+  the ID of the class being measured.
+  """
+  class_id = db.session.execute(
+    "insert into class_section (name) values ('Benchmark class') returning id"
+  ).scalar()
+
+  params = {'class_id': class_id, 'class_size': class_size, 'others': max(0, total - class_size)}
+  db.session.execute("""
+    insert into class_section (name)
+    select 'Benchmark other ' || g from generate_series(1, ceil(:others / 30.0)::int) g
+  """, params)
+
+  db.session.execute("""
+    insert into class_section_student (name, email, class_section_id, created_at)
+    select 'Benchmark ' || g, 'benchmark-' || g || '@example.com', :class_id, now()
+    from generate_series(1, :class_size) g
+  """, params)
+
+  db.session.execute("""
+    insert into class_section_student (name, email, class_section_id, created_at)
+    select 'Benchmark other ' || g, 'benchmark-other-' || g || '@example.com', c.id, now()
+    from generate_series(1, :others) g
+    join (
+      select id, row_number() over (order by id) - 1 as n
+      from class_section where name like 'Benchmark other %'
+    ) c on c.n = (g - 1) / 30
+  """, params)
+
+  # Everyone guides the next student of their class, ending the session
+  db.session.execute("""
+    insert into tutoring_session (guide_id, learner_id, skill, start_time, end_time, request_status)
+    select s.id, coalesce(
+      lead(s.id) over (partition by s.class_section_id order by s.id),
+      first_value(s.id) over (partition by s.class_section_id order by s.id)
+    ), 'skill-' || (s.id % 50), now(), now(), 'not_applicable'
+    from class_section_student s
+    join class_section c on c.id = s.class_section_id
+    where c.name like 'Benchmark%'
+  """)
+
+  db.session.execute('analyze')
+  return class_id
+
+
+def bench_algorithm(algorithm_id, student_ids, class_id, raw_args, runs, compare_to=None):
+  """
+  Prints the profile of a matching algorithm (and optionally a second one to
+  compare it with) for the given students, as the benchmark endpoint does
+  """
+  from .api.matching_api import benchmark_algorithms, benchmark_students
+
+  algorithm = MatchingAlgorithm.query.get(algorithm_id)
+  other = MatchingAlgorithm.query.get(compare_to) if compare_to is not None else None
+  if algorithm is None or (compare_to is not None and other is None):
+    raise ValueError('No such matching algorithm')
+
+  try:
+    students = benchmark_students(student_ids, class_id)
+    result = benchmark_algorithms(algorithm, other, students, raw_args, runs)
+  finally:
+    db.session.rollback()
+
+  reports = [result['algorithm']] + ([result['compare_to']] if 'compare_to' in result else [])
+  print('%-6s %-24s %10s %10s %10s %10s %10s' % ('id', 'name', 'p50 ms', 'p95 ms', 'p99 ms', 'max rows', 'seq scans'))
+  for report in reports:
+    latency = report['latency_ms']
+    print('%-6d %-24s %10.2f %10.2f %10.2f %10d %10d' % (
+      report['matching_algorithm_id'], report['name'][:24],
+      latency['p50'], latency['p95'], latency['p99'],
+      report['rows']['max'], len(report['seq_scans'])
+    ))
+
+  for report in reports:
+    print('\nPlan for %d (%s):' % (report['matching_algorithm_id'], report['name']))
+    print(json_lib.dumps(report['plan'], indent=2))
+    for scan in report['seq_scans']:
+      print('WARNING: sequential scan on %s (%d rows), filter: %s' % (scan['relation'], scan['table_rows'], scan['filter']))
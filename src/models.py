@@ -1,9 +1,16 @@
 from app import app
 import enum
 import datetime
+from contextlib import contextmanager
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import Boolean, Column, Enum, Integer, String, Date, DateTime, ForeignKey, Index, UniqueConstraint
-from sqlalchemy.dialects.postgresql import JSON
+from sqlalchemy import BigInteger, Boolean, Column, Enum, Float, Integer, String, Date, DateTime, ForeignKey, Index, UniqueConstraint, any_, case, cast, literal_column, select, text
+from sqlalchemy.dialects.postgresql import ARRAY, JSON, insert
+from sqlalchemy.exc import OperationalError
+from psycopg2.extensions import QueryCanceledError
+from psycopg2.extras import RealDictCursor, execute_values
+
+from .utils import query_compiler
+from .utils.cache import InvalidatingCache, notify, notify_tables
 
 db = SQLAlchemy(app)
 
@@ -16,6 +23,9 @@ class KASkillCompletionSource(enum.Enum):
 
 class ClassSectionStudent(db.Model):
     __tablename__ = 'class_section_student'
+    __table_args__ = (
+        Index('class_student_index', 'class_section_id', 'id'),
+    )
     
     id = Column(Integer, primary_key=True)
     name = Column(String, index=True)
@@ -70,15 +80,89 @@ class StudentHeartbeat(db.Model):
         return {
             'student_id': self.student_id,
             'skill': self.skill,
-            'time': self.time
+            'time': self.last_updated
         }
 
     def repeat(self):
         self.last_updated = datetime.datetime.utcnow()
 
+    @staticmethod
+    def latest_since(since):
+        """
+            Each student's most recent heartbeat since the given time
+        """
+        query = """
+            select distinct on (h.student_id)
+                h.student_id, s.class_section_id, h.device_id, h.skill, h.last_updated
+            from student_heartbeat h, class_section_student s
+            where
+                h.last_updated >= :since
+                and s.id = h.student_id
+            order by h.student_id, h.last_updated desc
+        """
+        return db.session.execute(query, {'since': since})
+
+    @staticmethod
+    def record_batch(entries):
+        """
+            Writes heartbeats merged by HeartbeatBuffer. As with a single ping,
+            a device's latest row is extended if it's still on the same skill;
+            otherwise a new row is started. Heartbeats for students that don't
+            exist are dropped.
+        """
+        student_ids = list(set(e['student_id'] for e in entries))
+        known_ids = set(
+            r[0] for r in db.session.query(ClassSectionStudent.id)
+                .filter(ClassSectionStudent.id.in_(student_ids))
+        )
+
+        query = """
+            select distinct on (student_id, device_id) id, student_id, device_id, skill
+            from student_heartbeat
+            where student_id = any(:student_ids)
+            order by student_id, device_id, last_updated desc
+        """
+        latest = {
+            (r['student_id'], r['device_id']): r
+            for r in db.session.execute(query, {'student_ids': list(known_ids)})
+        }
+
+        by_device = {}
+        for entry in entries:
+            if entry['student_id'] in known_ids:
+                pair = (entry['student_id'], entry['device_id'])
+                by_device.setdefault(pair, []).append(entry)
+
+        updates = []
+        inserts = []
+        for pair, device_entries in by_device.items():
+            device_entries.sort(key=lambda e: e['first_seen'])
+            prev = latest.get(pair)
+
+            for i, entry in enumerate(device_entries):
+                if i == 0 and prev is not None and prev['skill'] == entry['skill']:
+                    updates.append({'id': prev['id'], 'last_updated': entry['last_seen']})
+                else:
+                    inserts.append({
+                        'student_id': entry['student_id'],
+                        'device_id': entry['device_id'],
+                        'skill': entry['skill'],
+                        'created_at': entry['first_seen'],
+                        'last_updated': entry['last_seen']
+                    })
+
+        db.session.bulk_update_mappings(StudentHeartbeat, updates)
+        db.session.bulk_insert_mappings(StudentHeartbeat, inserts)
+        db.session.commit()
+
 
 class KASkillCompletion(db.Model):
     __tablename__ = 'ka_skill_completion'
+    __table_args__ = (
+        Index('created_at_id_index', 'created_at', 'id'), 
+        Index('student_skill_created_at_index', 'student_id', 'skill', 'created_at'),
+        Index('txid_id_index', 'txid', 'id'),
+    )
     
     id = Column(Integer, primary_key=True)
     student_id = Column(Integer, ForeignKey('class_section_student.id'), index=True, nullable=False)
@@ -92,6 +176,9 @@ class KASkillCompletion(db.Model):
     mastery_points_out_of = Column(Integer)
     recorded_from = Column(Enum(KASkillCompletionSource), nullable=False)
     created_at = Column(DateTime, default=datetime.datetime.utcnow, nullable=False, index=True)
+
+    # The inserting transaction, for the change feed (see get_ka_skill_completion_changes)
+    txid = Column(BigInteger, nullable=False, server_default=text('txid_current()'))
     
     def __init__(
         self, 
@@ -137,6 +224,188 @@ class KASkillCompletion(db.Model):
         # Only based on the question data (at least for now)
         return self.questions_out_of - self.questions_correct >= 2
 
+    @staticmethod
+    def bulk_insert(rows):
+        """
+            Inserts plain dicts (column => value, with recorded_from as a name)
+            in multi-row INSERT statements on the session's connection, and
+            returns the inserted rows in the same form as serialize()
+        """
+        if len(rows) == 0:
+            return []
+
+        columns = [
+            'student_id',
+            'course',
+            'unit',
+            'skill',
+            'questions_correct',
+            'questions_out_of',
+            'mastery_category',
+            'mastery_points',
+            'mastery_points_out_of',
+            'recorded_from',
+            'created_at'
+        ]
+        now = datetime.datetime.utcnow()
+        values = [tuple(row.get(c, now) if c == 'created_at' else row.get(c) for c in columns) for row in rows]
+
+        query = 'insert into ka_skill_completion (%s) values %%s returning id, %s' % (', '.join(columns), ', '.join(columns))
+        cursor = db.session.connection().connection.cursor(cursor_factory=RealDictCursor)
+        try:
+            return execute_values(cursor, query, values, page_size=1000, fetch=True)
+        finally:
+            cursor.close()
+
+    @staticmethod
+    def nearest_task(student_id, skill, time, before):
+        """
+            The student's last unit/lesson task completion of 'skill' before
+            'time', or their first one after it
+        """
+        query = KASkillCompletion.query \
+            .filter_by(student_id=student_id, skill=skill) \
+            .filter(KASkillCompletion.recorded_from.in_([
+                KASkillCompletionSource.unit_view_task,
+                KASkillCompletionSource.lesson_view_task
+            ]))
+
+        if before:
+            query = query.filter(KASkillCompletion.created_at < time) \
+                .order_by(KASkillCompletion.created_at.desc())
+        else:
+            query = query.filter(KASkillCompletion.created_at > time) \
+                .order_by(KASkillCompletion.created_at)
+
+        return query.first()
+
+    @staticmethod
+    def update_projections(completion_ids):
+        """
+            Keeps the tables derived from ka_skill_completion up to date; call
+            after flushing newly inserted completions
+        """
+        if len(completion_ids) == 0:
+            return
+
+        StudentSkillMastery.record_completions(completion_ids)
+        ClassSkill.record_completions(completion_ids)
+
+
+class StudentSkillMastery(db.Model):
+    """
+        One row per skill a student has mastered (see _find_guides), maintained
+        from ka_skill_completion by KASkillCompletion.update_projections
+    """
+    __tablename__ = 'student_skill_mastery'
+    __table_args__ = (
+        Index('class_skill_mastery_index', 'class_section_id', 'skill'), 
+    )
+
+    student_id = Column(Integer, ForeignKey('class_section_student.id'), primary_key=True)
+    skill = Column(String, primary_key=True)
+    class_section_id = Column(Integer, ForeignKey('class_section.id'))
+    mastered_at = Column(DateTime, nullable=False)
+    best_ratio = Column(Float)
+
+    def serialize(self):
+        return {
+            'student_id': self.student_id,
+            'class_section_id': self.class_section_id,
+            'skill': self.skill,
+            'mastered_at': self.mastered_at,
+            'best_ratio': self.best_ratio
+        }
+
+    @staticmethod
+    def record_completions(completion_ids):
+        query = """
+            insert into student_skill_mastery
+                (student_id, class_section_id, skill, mastered_at, best_ratio)
+            select
+                c.student_id,
+                s.class_section_id,
+                c.skill,
+                min(c.created_at),
+                max(c.questions_correct::float / nullif(c.questions_out_of, 0))
+            from ka_skill_completion c, class_section_student s
+            where
+                c.id = any(:completion_ids)
+                and s.id = c.student_id
+                and (
+                    c.mastery_category = 'mastered'
+                    or c.mastery_category = 'proficient'
+                    or c.questions_correct = c.questions_out_of
+                )
+            group by c.student_id, s.class_section_id, c.skill
+            on conflict (student_id, skill) do update set
+                class_section_id = excluded.class_section_id,
+                mastered_at = least(student_skill_mastery.mastered_at, excluded.mastered_at),
+                best_ratio = greatest(student_skill_mastery.best_ratio, excluded.best_ratio)
+        """
+        db.session.execute(query, {'completion_ids': list(completion_ids)})
+
+
+class ClassSkill(db.Model):
+    """
+        The skills each class section has completions for, maintained from
+        ka_skill_completion by KASkillCompletion.update_projections
+    """
+    __tablename__ = 'class_skill'
+    __table_args__ = (
+        Index('class_skill_last_seen_index', 'class_section_id', 'last_seen'),
+        Index('class_skill_count_index', 'class_section_id', 'completion_count'),
+    )
+
+    class_section_id = Column(Integer, ForeignKey('class_section.id'), primary_key=True)
+    skill = Column(String, primary_key=True)
+    first_seen = Column(DateTime, nullable=False)
+    last_seen = Column(DateTime, nullable=False)
+    completion_count = Column(Integer, nullable=False)
+
+    def serialize(self):
+        return {
+            'class_section_id': self.class_section_id,
+            'skill': self.skill,
+            'first_seen': self.first_seen,
+            'last_seen': self.last_seen,
+            'completion_count': self.completion_count
+        }
+
+    @staticmethod
+    def for_class(class_section_id, sort=None):
+        """
+            'sort' is None (by skill), 'recent' (latest completion first) or
+            'active' (most completions first)
+        """
+        query = db.session.query(ClassSkill.skill).filter_by(class_section_id=class_section_id)
+        if sort is None:
+            return query.order_by(ClassSkill.skill)
+        if sort == 'recent':
+            return query.order_by(ClassSkill.last_seen.desc(), ClassSkill.skill)
+        if sort == 'active':
+            return query.order_by(ClassSkill.completion_count.desc(), ClassSkill.skill)
+        raise ValueError('Cannot sort by %s' % sort)
+
+    @staticmethod
+    def record_completions(completion_ids):
+        query = """
+            insert into class_skill
+                (class_section_id, skill, first_seen, last_seen, completion_count)
+            select s.class_section_id, c.skill, min(c.created_at), max(c.created_at), count(*)
+            from ka_skill_completion c, class_section_student s
+            where
+                c.id = any(:completion_ids)
+                and s.id = c.student_id
+                and s.class_section_id is not null
+            group by s.class_section_id, c.skill
+            on conflict (class_section_id, skill) do update set
+                first_seen = least(class_skill.first_seen, excluded.first_seen),
+                last_seen = greatest(class_skill.last_seen, excluded.last_seen),
+                completion_count = class_skill.completion_count + excluded.completion_count
+        """
+        db.session.execute(query, {'completion_ids': list(completion_ids)})
+
 
 class ClassSection(db.Model):
     __tablename__ = 'class_section'
@@ -165,8 +434,19 @@ class SessionRequestStatus(enum.Enum):
     cancelled = 4
 
 
+# First key of the advisory locks taken by TutoringSession.lock_students
+SESSION_LOCK_NAMESPACE = 1
+
+
 class TutoringSession(db.Model):
     __tablename__ = 'tutoring_session'
+    __table_args__ = (
+        # A student can be the learner / the guide of at most one open session
+        Index('active_learner_index', 'learner_id', unique=True, postgresql_where=text('end_time IS NULL')),
+        Index('active_guide_index', 'guide_id', unique=True, postgresql_where=text('end_time IS NULL')),
+        Index('guide_start_time_index', 'guide_id', 'start_time'),
+        Index('learner_start_time_index', 'learner_id', 'start_time'),
+    )
 
     id = Column(Integer, primary_key=True)
     guide_id = Column(Integer, ForeignKey('class_section_student.id'), nullable=False, index=True)
@@ -205,11 +485,25 @@ class TutoringSession(db.Model):
         else:
             self.request_status = SessionRequestStatus.not_applicable
 
+    def activate(self):
+        """
+            Registers a newly added session as both students' active session
+        """
+        db.session.flush()
+        db.session.add(ActiveTutoringSession(student_id=self.learner_id, role='learner', session_id=self.id))
+        db.session.add(ActiveTutoringSession(student_id=self.guide_id, role='guide', session_id=self.id))
+
+    def deactivate(self):
+        ActiveTutoringSession.query \
+            .filter_by(session_id=self.id) \
+            .delete(synchronize_session=False)
+
     def reject(self, note):
         self.cancellation_reason = 'request_rejected'
         self.request_status = SessionRequestStatus.rejected
         self.rejection_note = note
         self.end_time = datetime.datetime.utcnow()
+        self.deactivate()
 
     def accept(self):
         self.request_status = SessionRequestStatus.accepted
@@ -220,9 +514,72 @@ class TutoringSession(db.Model):
 
         if self.request_status == SessionRequestStatus.pending:
             self.request_status = SessionRequestStatus.cancelled
+        self.deactivate()
 
     def finish(self):
         self.end_time = datetime.datetime.utcnow()
+        self.deactivate()
+
+    @staticmethod
+    def for_class(class_section_id, since=None, until=None, status=None):
+        """
+            Sessions with a guide or learner in the class section, started in
+            [since, until). 'status' is 'active', 'ended' or a request status.
+            Each side of the union walks class_section_student by class and then
+            the (student, start_time) indexes, so the cost follows the class size.
+            The IDs are collected into an array so the outer query probes the
+            primary key for each of them: with 'id IN (...)' Postgres tends to
+            merge join against a full primary key scan once it is ordered by ID.
+        """
+        students = db.session.query(ClassSectionStudent.id) \
+            .filter(ClassSectionStudent.class_section_id == class_section_id)
+
+        def sessions_by(column):
+            query = db.session.query(TutoringSession.id.label('id')).filter(column.in_(students))
+            if since is not None:
+                query = query.filter(TutoringSession.start_time >= since)
+            if until is not None:
+                query = query.filter(TutoringSession.start_time < until)
+            return query
+
+        ids = sessions_by(TutoringSession.guide_id).union(sessions_by(TutoringSession.learner_id)).subquery()
+        query = TutoringSession.query.filter(TutoringSession.id == any_(
+            cast(select([db.func.array_agg(ids.c.id)]).as_scalar(), ARRAY(Integer))
+        ))
+
+        if status == 'active':
+            query = query.filter(TutoringSession.end_time.is_(None))
+        elif status == 'ended':
+            query = query.filter(TutoringSession.end_time.isnot(None))
+        elif status is not None:
+            if status not in SessionRequestStatus.__members__:
+                raise ValueError('Unknown status %s' % status)
+            query = query.filter(TutoringSession.request_status == SessionRequestStatus[status])
+
+        return query
+
+    @staticmethod
+    def lock_students(student_ids):
+        """
+            Serializes session creation for these students until the end of the
+            transaction. Locks are taken in ID order so two requests for the same
+            pair can't deadlock.
+        """
+        for student_id in sorted(set(student_ids)):
+            db.session.execute(
+                'select pg_advisory_xact_lock(:namespace, :student_id)',
+                {'namespace': SESSION_LOCK_NAMESPACE, 'student_id': student_id}
+            )
+
+    @staticmethod
+    def busy_students(student_ids):
+        """
+            The subset of 'student_ids' currently in an open session, either as
+            learner or guide
+        """
+        rows = db.session.query(ActiveTutoringSession.student_id) \
+            .filter(ActiveTutoringSession.student_id.in_(list(student_ids)))
+        return set(r[0] for r in rows)
 
     def serialize(self):
         request_status = self.request_status.name if self.request_status is not None else None
@@ -241,6 +598,133 @@ class TutoringSession(db.Model):
             'rejection_note': self.rejection_note
         }
 
+
+class ActiveTutoringSession(db.Model):
+    """
+        The open session of each student, one row per role, kept up to date by
+        TutoringSession.activate and the transitions that end a session
+    """
+    __tablename__ = 'active_tutoring_session'
+
+    student_id = Column(Integer, ForeignKey('class_section_student.id'), primary_key=True)
+    role = Column(String, primary_key=True) # 'learner' or 'guide'
+    session_id = Column(Integer, ForeignKey('tutoring_session.id'), nullable=False, index=True)
+
+    @staticmethod
+    def lookup(student_id, role):
+        """
+            The student's open session in this role along with the other student
+            in it, or None
+        """
+        counterpart_id = TutoringSession.guide_id if role == 'learner' else TutoringSession.learner_id
+        return db.session.query(TutoringSession, ClassSectionStudent) \
+            .join(ActiveTutoringSession, ActiveTutoringSession.session_id == TutoringSession.id) \
+            .join(ClassSectionStudent, ClassSectionStudent.id == counterpart_id) \
+            .filter(ActiveTutoringSession.student_id == student_id) \
+            .filter(ActiveTutoringSession.role == role) \
+            .first()
+
+
+# Sessions that ended longer ago than this stop being checked for an 'after'
+# completion (see SessionLearningGain.compute)
+LEARNING_GAIN_WINDOW_DAYS = 14
+
+
+class SessionLearningGain(db.Model):
+    """
+        The learner's task completion of the session's skill right before and
+        right after each ended session, for the dashboard. Filled in by
+        SessionLearningGain.compute.
+    """
+    __tablename__ = 'session_learning_gain'
+
+    session_id = Column(Integer, ForeignKey('tutoring_session.id'), primary_key=True)
+    learner_id = Column(Integer, ForeignKey('class_section_student.id'), nullable=False, index=True)
+    skill = Column(String)
+    before_completion_id = Column(Integer, ForeignKey('ka_skill_completion.id'))
+    after_completion_id = Column(Integer, ForeignKey('ka_skill_completion.id'))
+    before_ratio = Column(Float)
+    after_ratio = Column(Float)
+    gain = Column(Float)
+    computed_at = Column(DateTime, nullable=False)
+
+    def serialize(self):
+        return {
+            'session_id': self.session_id,
+            'learner_id': self.learner_id,
+            'skill': self.skill,
+            'before_completion_id': self.before_completion_id,
+            'after_completion_id': self.after_completion_id,
+            'before_ratio': self.before_ratio,
+            'after_ratio': self.after_ratio,
+            'gain': self.gain,
+            'computed_at': self.computed_at
+        }
+
+    @staticmethod
+    def compute(recompute=False, window_days=LEARNING_GAIN_WINDOW_DAYS):
+        """
+            Computes the gains of every ended session in one statement: two
+            lateral lookups per session on (student_id, skill, created_at). Only
+            sessions without a row, or that ended within the last 'window_days'
+            and are still waiting for an 'after' completion, are visited unless
+            'recompute' is set. Returns the number of rows written.
+        """
+        query = """
+            insert into session_learning_gain (
+                session_id, learner_id, skill,
+                before_completion_id, after_completion_id,
+                before_ratio, after_ratio, gain, computed_at
+            )
+            select
+                t.id, t.learner_id, t.skill,
+                b.id, a.id,
+                b.ratio, a.ratio, a.ratio - b.ratio,
+                now() at time zone 'utc'
+            from tutoring_session t
+            left join session_learning_gain g on g.session_id = t.id
+            left join lateral (
+                select k.id, k.questions_correct::float / nullif(k.questions_out_of, 0) as ratio
+                from ka_skill_completion k
+                where
+                    k.student_id = t.learner_id
+                    and k.skill = t.skill
+                    and k.created_at < t.start_time
+                    and k.recorded_from in ('unit_view_task', 'lesson_view_task')
+                order by k.created_at desc
+                limit 1
+            ) b on true
+            left join lateral (
+                select k.id, k.questions_correct::float / nullif(k.questions_out_of, 0) as ratio
+                from ka_skill_completion k
+                where
+                    k.student_id = t.learner_id
+                    and k.skill = t.skill
+                    and k.created_at > t.end_time
+                    and k.recorded_from in ('unit_view_task', 'lesson_view_task')
+                order by k.created_at asc
+                limit 1
+            ) a on true
+            where
+                t.end_time is not null
+                and (
+                    :recompute
+                    or g.session_id is null
+                    or (g.after_completion_id is null and t.end_time >= :window_start)
+                )
+            on conflict (session_id) do update set
+                before_completion_id = excluded.before_completion_id,
+                after_completion_id = excluded.after_completion_id,
+                before_ratio = excluded.before_ratio,
+                after_ratio = excluded.after_ratio,
+                gain = excluded.gain,
+                computed_at = excluded.computed_at
+        """
+        window_start = datetime.datetime.utcnow() - datetime.timedelta(days=window_days)
+        result = db.session.execute(query, {'recompute': recompute, 'window_start': window_start})
+        notify_tables(db.session, [SessionLearningGain.__tablename__])
+        return result.rowcount
+
 """
     Forms
 """
@@ -269,6 +753,14 @@ class Form(db.Model):
     def num_questions(self):
         return FormQuestion.query.filter_by(form_id=self.id).count()
 
+    @staticmethod
+    def lock(form_id):
+        """
+            Loads the form with its row locked until the end of the transaction,
+            so edits to its question order don't interleave
+        """
+        return Form.query.filter_by(id=form_id).with_for_update().first()
+
 
 class Question(db.Model):
     __tablename__ = 'question'
@@ -284,7 +776,11 @@ class Question(db.Model):
         self.question_type = question_type
         self.options = options
 
-    def serialize(self, include_num_responses=True):
+    def serialize(self, include_num_responses=True, num_responses=None):
+        """
+            Pass 'num_responses' (see QuestionResponseCount.counts) when
+            serializing many questions to avoid a query per question
+        """
         data = {
             'id': self.id,
             'question': self.question,
@@ -294,22 +790,15 @@ class Question(db.Model):
         }
 
         if include_num_responses:
-            data['num_responses'] = self.num_responses()
+            if num_responses is None:
+                num_responses = self.num_responses()
+            data['num_responses'] = num_responses
 
         return data
 
     def num_responses(self):
-        query = """
-            select count(*) from
-                question q,
-                form_question fq,
-                form_response fr
-            where
-                q.id = fq.question_id
-                and fq.id = fr.form_question_id
-        """
-        result = db.session.execute(query)
-        return result.scalar()
+        count = QuestionResponseCount.query.get(self.id)
+        return count.num_responses if count is not None else 0
     
     def archive(self, archive=True):
         if archive:
@@ -318,6 +807,50 @@ class Question(db.Model):
             self.archived_at = None
 
 
+class QuestionResponseCount(db.Model):
+    """
+        Number of form responses per question, kept up to date as responses
+        are created (see create_responses_for_distribution)
+    """
+    __tablename__ = 'question_response_count'
+
+    question_id = Column(Integer, ForeignKey('question.id'), primary_key=True)
+    num_responses = Column(Integer, nullable=False, default=0)
+
+    @staticmethod
+    def increment(counts):
+        """
+            Where 'counts' maps question IDs to the number of new responses
+        """
+        if len(counts) == 0:
+            return
+
+        # Rows are locked in question ID order, so concurrent submissions
+        # touching the same questions can't deadlock
+        question_ids = sorted(counts)
+        query = """
+            insert into question_response_count (question_id, num_responses)
+            select c.question_id, c.num_responses
+            from unnest(cast(:question_ids as integer[]), cast(:counts as integer[]))
+                as c (question_id, num_responses)
+            order by c.question_id
+            on conflict (question_id) do update set
+                num_responses = question_response_count.num_responses + excluded.num_responses
+        """
+        db.session.execute(query, {
+            'question_ids': question_ids,
+            'counts': [counts[question_id] for question_id in question_ids]
+        })
+
+    @staticmethod
+    def counts():
+        """
+            Question ID => number of responses, for every question with any
+        """
+        rows = db.session.query(QuestionResponseCount.question_id, QuestionResponseCount.num_responses)
+        return dict(rows)
+
+
 class Label(db.Model):
     __tablename__ = 'label'
 
@@ -385,6 +918,32 @@ class FormQuestion(db.Model):
     def archive(self):
         self.archived_at = datetime.datetime.utcnow()
 
+    @staticmethod
+    def ordered_ids(form_id):
+        rows = db.session.query(FormQuestion.id) \
+            .filter_by(form_id=form_id) \
+            .order_by(FormQuestion.index_in_form, FormQuestion.id)
+        return [r[0] for r in rows]
+
+    @staticmethod
+    def apply_order(form_id, ids):
+        """
+            Sets each form question's index_in_form to its position in 'ids' with
+            a single UPDATE, and returns the rows that changed (serialized)
+        """
+        table = FormQuestion.__table__
+        new_index = case({id: i for i, id in enumerate(ids)}, value=table.c.id)
+        stmt = table.update() \
+            .where(table.c.form_id == form_id) \
+            .where(table.c.id.in_(ids)) \
+            .where(table.c.index_in_form != new_index) \
+            .values(index_in_form=new_index) \
+            .returning(*table.columns)
+
+        rows = db.session.execute(stmt).fetchall()
+        notify_tables(db.session, [table.name])
+        return [dict(r) for r in rows]
+
 
 class FormResponse(db.Model):
     __tablename__ = 'form_response'
@@ -418,17 +977,46 @@ class FormResponse(db.Model):
         self.response = response
 
     def serialize(self):
+        return FormResponse.serialize_row(self)
+
+    @staticmethod
+    def serialize_row(row):
+        """
+            Serializes a FormResponse or a result row with the same columns
+        """
         return {
-            'id': self.id,
-            'form_question_id': self.form_question_id,
-            'form_distribution_id': self.form_distribution_id,
-            'session_id': self.session_id,
-            'class_section_student_id': self.class_section_student_id,
-            'original_question_index': self.original_question_index,
-            'response': self.response,
-            'created_at': self.created_at
+            'id': row.id,
+            'form_question_id': row.form_question_id,
+            'form_distribution_id': row.form_distribution_id,
+            'session_id': row.session_id,
+            'class_section_student_id': row.class_section_student_id,
+            'original_question_index': row.original_question_index,
+            'response': row.response,
+            'created_at': row.created_at
         }
 
+    @staticmethod
+    def upsert_all(rows):
+        """
+            Inserts the rows (dicts of column => value) in one statement. A row
+            that already exists for the same session, student and question
+            (e.g. a retried submission) gets its response replaced instead of
+            failing the whole batch. Returns every row, with 'inserted' telling
+            new rows apart from updated ones.
+        """
+        if len(rows) == 0:
+            return []
+
+        table = FormResponse.__table__
+        stmt = insert(table).values(rows)
+        stmt = stmt \
+            .on_conflict_do_update(
+                constraint='_session_student_response_uc',
+                set_={'response': stmt.excluded.response}
+            ) \
+            .returning(*(list(table.columns) + [literal_column('(xmax = 0)').label('inserted')]))
+        return db.session.execute(stmt).fetchall()
+
 
 class FormDistribution(db.Model):
     __tablename__ = 'form_distribution'
@@ -447,7 +1035,11 @@ class FormDistribution(db.Model):
         self.class_section_id = class_section_id
         self.applicable_date = applicable_date
 
-    def serialize(self, include_num_responses=True):
+    def serialize(self, include_num_responses=True, num_responses=None):
+        """
+            Pass 'num_responses' (see response_counts) when serializing many
+            distributions to avoid a query per distribution
+        """
         data = {
             'id': self.id,
             'form_id': self.form_id,
@@ -456,15 +1048,28 @@ class FormDistribution(db.Model):
         }
 
         if include_num_responses:
-            data['num_responses'] = self.num_responses()
+            if num_responses is None:
+                num_responses = self.num_responses()
+            data['num_responses'] = num_responses
 
         return data
 
     def num_responses(self):
-        query = """
-            select count(*) from form_response where form_distribution_id = %d
-        """ % (self.id)
-        return db.session.execute(query).scalar()
+        return FormDistribution.response_counts([self.id]).get(self.id, 0)
+
+    @staticmethod
+    def response_counts(distribution_ids):
+        """
+            Distribution ID => number of responses, for those of the given
+            distributions with any, counted with a single GROUP BY
+        """
+        if len(distribution_ids) == 0:
+            return {}
+
+        query = db.session.query(FormResponse.form_distribution_id, db.func.count(FormResponse.id)) \
+            .filter(FormResponse.form_distribution_id.in_(distribution_ids)) \
+            .group_by(FormResponse.form_distribution_id)
+        return dict(query)
 
 
 class MatchingAlgorithm(db.Model):
@@ -475,6 +1080,13 @@ class MatchingAlgorithm(db.Model):
     description = Column(String)
     sql_query = Column(String, nullable=False)
     args = Column(JSON, nullable=False, default=[])
+    version = Column(Integer, nullable=False, default=1, server_default='1')
+
+    # Budgets; see execute and check_cost
+    statement_timeout_ms = Column(Integer, nullable=False, default=2000, server_default='2000')
+    max_rows = Column(Integer, nullable=False, default=1000, server_default='1000')
+    max_cost = Column(Float)
+    sample_args = Column(JSON)
 
     def init(self, name, description, sql_query, args):
         self.name = name
@@ -488,15 +1100,126 @@ class MatchingAlgorithm(db.Model):
             'name': self.name,
             'description': self.description,
             'sql_query': self.sql_query,
-            'args': self.args
+            'args': self.args,
+            'version': self.version,
+            'statement_timeout_ms': self.statement_timeout_ms,
+            'max_rows': self.max_rows,
+            'max_cost': self.max_cost,
+            'sample_args': self.sample_args
         }
 
+    def set_query(self, sql_query=None, args=None):
+        """
+            Changes the query and/or its arguments, bumping the version so that
+            previously compiled statements aren't reused
+        """
+        if sql_query is not None:
+            self.sql_query = sql_query
+        if args is not None:
+            self.args = args
+
+        self.version = (self.version or 1) + 1
+        query_compiler.invalidate(self.id)
+
+    def compiled(self):
+        return query_compiler.compile_query(self.id, self.version, self.sql_query)
+
+    def build_args(self, student, values):
+        """
+            The query's arguments for a student: 'field' args are read from the
+            student, 'raw' args from 'values' (request args or a dict)
+        """
+        args = []
+        for arg in self.args:
+            if arg['type'] == 'field':
+                args.append(getattr(student, arg['field']))
+            elif arg['type'] == 'raw':
+                val = values.get(arg['field'])
+                if val is None:
+                    raise ValueError('Must provide %s' % arg['field'])
+                else:
+                    args.append(val)
+        return args
+
+    def set_budgets(self, values):
+        for key in ['statement_timeout_ms', 'max_rows']:
+            if values.get(key) is not None:
+                if int(values[key]) <= 0:
+                    raise ValueError('%s must be positive' % key)
+                setattr(self, key, int(values[key]))
+
+        if 'max_cost' in values:
+            self.max_cost = float(values['max_cost']) if values['max_cost'] is not None else None
+        if 'sample_args' in values:
+            self.sample_args = values['sample_args']
+
     def execute(self, args):
         """
-            Where 'args' is a list of arguments
+            Where 'args' is a list of arguments. Runs outside the request's
+            transaction, on a read-only one of its own limited to
+            statement_timeout_ms, and streams at most max_rows rows from a server
+            side cursor. Returns the rows (as dicts) and whether there were more.
+        """
+        compiled = self.compiled()
+        with self.sandbox() as connection:
+            result = connection \
+                .execution_options(stream_results=True) \
+                .execute(compiled.statement, compiled.params(args))
+            rows = result.fetchmany(self.max_rows + 1)
+            result.close()
+
+        truncated = len(rows) > self.max_rows
+        if truncated:
+            print('Matching algorithm %d returned more than %d rows' % (self.id, self.max_rows))
+        return [dict(r) for r in rows[:self.max_rows]], truncated
+
+    def check_cost(self):
         """
-        query = self.sql_query % tuple(args)
-        return db.session.execute(query)
+            Has the planner estimate the query's cost with sample_args, raising
+            if it's over max_cost. Returns the estimate, or None without a
+            max_cost. Call after flushing, so that the algorithm has an ID.
+        """
+        if self.max_cost is None:
+            return None
+
+        sample_args = self.sample_args
+        if sample_args is None:
+            if len(self.args or []) > 0:
+                raise ValueError('Must provide sample_args to check the cost of an algorithm with arguments')
+            sample_args = []
+
+        compiled = self.compiled()
+        with self.sandbox() as connection:
+            plan = connection.execute(
+                compiled.explain_statement('FORMAT JSON'),
+                compiled.params(sample_args)
+            ).scalar()
+
+        plan = plan[0] if isinstance(plan, list) else plan
+        cost = plan['Plan']['Total Cost']
+        if cost > self.max_cost:
+            raise ValueError('Estimated cost %.0f is over the budget of %.0f' % (cost, self.max_cost))
+        return cost
+
+    @contextmanager
+    def sandbox(self):
+        """
+            A connection of its own in a read-only transaction limited to
+            statement_timeout_ms, rolled back on exit
+        """
+        connection = db.engine.connect()
+        transaction = connection.begin()
+        try:
+            connection.execute('set transaction read only')
+            connection.execute('set local statement_timeout = %d' % int(self.statement_timeout_ms))
+            yield connection
+        except OperationalError as e:
+            if isinstance(e.orig, QueryCanceledError):
+                raise ValueError('Matching algorithm took longer than its budget of %d ms' % self.statement_timeout_ms)
+            raise
+        finally:
+            transaction.rollback()
+            connection.close()
 
 
 class ActiveMatchingAlgorithm(db.Model):
@@ -537,14 +1260,24 @@ class OnlineMode(db.Model):
     online_mode = Column(String, primary_key=True, default='online_mode')
     is_online = Column(Boolean, default=False, nullable=False)
 
+    cache = InvalidatingCache('online_mode')
+
     @staticmethod
     def set_online(online):
+        """
+            Every worker drops its cached flag once this is committed
+        """
         row = OnlineMode.query.get('online_mode')
 
         if row is None:
             row = OnlineMode.create_default()
         
         row.is_online = online
+        notify(db.session, OnlineMode.cache.topic)
+
+    @staticmethod
+    def is_online_cached():
+        return OnlineMode.cache.get('online_mode', lambda key: OnlineMode.get().is_online)
 
     @staticmethod
     def get():
@@ -567,4 +1300,15 @@ class OnlineMode(db.Model):
     def serialize(self):
         return {
             'is_online': self.is_online
-        }
\ No newline at end of file
+        }
+
+
+class TableVersion(db.Model):
+    """
+        A counter per table, bumped by every transaction that writes to it
+        (for tables registered through api_utils.conditional), used for ETags
+    """
+    __tablename__ = 'table_version'
+
+    table_name = Column(String, primary_key=True)
+    version = Column(BigInteger, nullable=False, default=0)
@@ -1,4 +1,20 @@
-from flask import jsonify
+import base64
+import datetime
+import enum
+import hashlib
+import json as json_lib
+from functools import wraps
+
+from flask import Response, current_app, jsonify, make_response, request, stream_with_context
+from flask.json import dumps
+from sqlalchemy import DateTime, text, tuple_
+
+from .cache import InvalidatingCache, versioned
+
+# Rows fetched per round trip when streaming through a server-side cursor
+STREAM_BATCH_SIZE = 500
+
+MAX_PAGE_SIZE = 1000
 
 def error(http_error=400, message=None, error=None):
   errorMessage = 'Something went wrong.'
@@ -22,4 +38,215 @@ def get_values(json, keys):
   if len(values) == 1:
     return values[0]
   else:
-    return values
\ No newline at end of file
+    return values
+
+
+def list_response(query, serialize=None, serialize_rows=None):
+  """
+  Responds with the rows of 'query' (a query on a single model), supporting:
+
+    ?limit=&after=  keyset pagination; the response becomes
+                    {data: [...], next_cursor: string|null} and next_cursor
+                    is passed back as 'after' to get the next page
+    ?order=         'id' (default) or 'created_at', the key to paginate on
+    ?fields=        comma-separated columns to select instead of whole rows
+    ?format=ndjson  stream one JSON object per line (see stream_ndjson)
+
+  Without 'limit' or 'after' a plain JSON array is returned, as before.
+
+  'serialize_rows', if given, serializes a whole page (or streamed batch) of
+  rows at once, for serializers that need to look things up for all of them.
+  """
+  model = query.column_descriptions[0]['entity']
+  keys = _order_keys(model)
+  query = query.order_by(*keys)
+
+  after = request.args.get('after')
+  if after is not None:
+    values = decode_cursor(after, keys)
+    query = query.filter(tuple_(*keys) > tuple_(*values))
+
+  fields = request.args.get('fields')
+  if fields is not None:
+    fields = _projected_fields(model, fields)
+    selected = fields + [k.key for k in keys if k.key not in fields]
+    query = query.with_entities(*[getattr(model, f) for f in selected])
+    serialize = lambda row: {f: _plain(getattr(row, f)) for f in fields}
+    serialize_rows = None
+  elif serialize is None:
+    serialize = lambda row: row.serialize()
+
+  if serialize_rows is None:
+    serialize_rows = lambda rows: [serialize(row) for row in rows]
+
+  limit = parse_limit(request.args.get('limit'))
+
+  if request.args.get('format') == 'ndjson':
+    return stream_ndjson(query.limit(limit), serialize_rows)
+
+  if limit is None and after is None:
+    return jsonify(serialize_rows(query.all()))
+
+  # One extra row tells us whether there's another page
+  rows = query.limit(limit + 1 if limit is not None else None).all()
+  next_cursor = None
+  if limit is not None and len(rows) > limit:
+    rows = rows[:limit]
+    next_cursor = encode_cursor([getattr(rows[-1], k.key) for k in keys])
+
+  return jsonify({
+    'data': serialize_rows(rows),
+    'next_cursor': next_cursor
+  })
+
+
+def parse_limit(limit, default=None):
+  """
+  A ?limit= value clamped to [1, MAX_PAGE_SIZE], or 'default' if missing
+  """
+  if limit is None:
+    return default
+
+  try:
+    limit = int(limit)
+  except ValueError:
+    raise ValueError('limit must be an integer')
+  return max(1, min(limit, MAX_PAGE_SIZE))
+
+
+def encode_cursor(values):
+  values = [v.isoformat() if isinstance(v, datetime.datetime) else v for v in values]
+  return base64.urlsafe_b64encode(json_lib.dumps(values).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor, keys):
+  try:
+    values = json_lib.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+  except Exception:
+    raise ValueError('Invalid cursor')
+
+  if not isinstance(values, list) or len(values) != len(keys):
+    raise ValueError('Invalid cursor')
+
+  return [
+    datetime.datetime.fromisoformat(v) if isinstance(k.type, DateTime) else v
+    for k, v in zip(keys, values)
+  ]
+
+
+def _order_keys(model):
+  order = request.args.get('order', 'id')
+  # 'id' is the primary key, whatever its column is called
+  pk = getattr(model, model.__mapper__.primary_key[0].key)
+  if order == 'id':
+    return [pk]
+  if order == 'created_at' and hasattr(model, 'created_at'):
+    return [model.created_at, pk]
+  raise ValueError('Cannot order by %s' % order)
+
+
+def _projected_fields(model, fields):
+  columns = model.__table__.columns.keys()
+  fields = [f for f in fields.split(',') if f != '']
+  for f in fields:
+    if f not in columns:
+      raise ValueError('Unknown field %s' % f)
+  return fields
+
+
+def _plain(value):
+  if isinstance(value, enum.Enum):
+    return value.name
+  return value
+
+
+def stream_ndjson(query, serialize_rows):
+  rows = query.yield_per(STREAM_BATCH_SIZE)
+
+  def generate():
+    batch = []
+    for row in rows:
+      batch.append(row)
+      if len(batch) == STREAM_BATCH_SIZE:
+        yield ''.join(dumps(d) + '\n' for d in serialize_rows(batch))
+        batch = []
+    if len(batch) > 0:
+      yield ''.join(dumps(d) + '\n' for d in serialize_rows(batch))
+
+  return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
+def conditional(tables=None, verify=None):
+  """
+  Decorator for read-mostly GET endpoints. The ETag is derived from the app
+  version, the URL and the versions of the tables the response is built
+  from, which are bumped whenever those tables are written (see
+  notify_tables). A request whose If-None-Match matches gets a 304 without
+  running the endpoint. Without tables, the ETag is a hash of the response.
+
+  'verify' (e.g. verify_admin) is checked before answering a 304.
+  """
+  tables = list(tables) if tables is not None else []
+  versioned(tables)
+  for table in tables:
+    if table not in _table_versions:
+      _table_versions[table] = InvalidatingCache('table_version:%s' % table, tables=[table])
+
+  def decorator(f):
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+      if verify is not None:
+        try:
+          verify()
+        except Exception as e:
+          return error(403, error=e)
+
+      if len(tables) == 0:
+        # Nothing to version: the response is static, so hash it instead
+        response = make_response(f(*args, **kwargs))
+        if response.status_code == 200:
+          response.set_etag(hashlib.sha1(response.get_data()).hexdigest())
+          response.make_conditional(request)
+        return response
+
+      etag = _etag(tables)
+      if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+
+      response = make_response(f(*args, **kwargs))
+      if response.status_code == 200:
+        response.set_etag(etag)
+      return response
+
+    return wrapper
+
+  return decorator
+
+
+# Table name => cache of its current version
+_table_versions = {}
+
+
+def _etag(tables):
+  versions = [
+    '%s:%d' % (table, _table_versions[table].get(table, _load_table_version))
+    for table in sorted(tables)
+  ]
+  key = '%s|%s?%s|%s' % (
+    current_app.config.get('APP_VERSION', ''),
+    request.path,
+    request.query_string.decode('utf-8'),
+    ','.join(versions)
+  )
+  return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def _load_table_version(table):
+  session = current_app.extensions['sqlalchemy'].db.session
+  version = session.execute(
+    text('select version from table_version where table_name = :table'),
+    {'table': table}
+  ).scalar()
+  return version or 0
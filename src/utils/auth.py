@@ -1,26 +1,98 @@
-from flask import request
-from firebase_admin import auth
+from flask import g, request
 
-admin_emails = []
+from .token_verifier import verify_id_token
 
-def verify_admin():
+admin_emails = set()
+
+
+class AuthContext(object):
+  """
+  The caller of the current request, decoded once by load_auth_context
+  (registered as a before_request hook) and shared by every verify_* call
+  and student lookup made while handling the request.
+  """
+  def __init__(self, claims=None, error=None):
+    self.claims = claims
+    self.error = error
+    self._student = None
+    self._student_loaded = False
+
+  @property
+  def email(self):
+    if self.claims is None:
+      return None
+    return self.claims.get('email')
+
+  @property
+  def is_admin(self):
+    return self.email is not None and is_admin(self.email)
+
+  @property
+  def student(self):
+    """
+    The ClassSectionStudent the token belongs to (None for admins)
+    """
+    if not self._student_loaded and self.email is not None:
+      from ..models import ClassSectionStudent
+      self._student = ClassSectionStudent.query.filter_by(email=self.email).first()
+      self._student_loaded = True
+    return self._student
+
+  def student_for(self, student_id):
+    """
+    Looks up a student by ID, reusing the caller's own student when it's the
+    same one (the common case for the extension's endpoints).
+    """
+    if self._student is not None and self._student.id == student_id:
+      return self._student
+
+    from ..models import ClassSectionStudent
+    student = ClassSectionStudent.query.get(student_id)
+    if student is not None and self.email is not None and student.email == self.email:
+      self._student = student
+      self._student_loaded = True
+    return student
+
+
+def load_auth_context():
   auth_header = request.headers.get('Authorization')
-  token = __parseAuthHeader(auth_header)
-  decoded_token = auth.verify_id_token(token)
-  
-  if not is_admin(decoded_token['email']):
+  if auth_header is None:
+    context = AuthContext(error=ValueError('Must provide an authorization header.'))
+  else:
+    try:
+      token = __parseAuthHeader(auth_header)
+      context = AuthContext(claims=verify_id_token(token))
+    except Exception as e:
+      context = AuthContext(error=e)
+
+  g.auth_context = context
+  return context
+
+
+def current_auth():
+  context = g.get('auth_context')
+  if context is None:
+    context = load_auth_context()
+  return context
+
+
+def verify_admin():
+  context = verify_user()
+  if not context.is_admin:
     raise ValueError('Invalid Email')
-  
+  return context
+
 
 def is_admin(email):
   return email in admin_emails
 
-  
+
 def verify_user():
-  auth_header = request.headers.get('Authorization')
-  token = __parseAuthHeader(auth_header)
-  auth.verify_id_token(token)
-  
+  context = current_auth()
+  if context.error is not None:
+    raise context.error
+  return context
+
 
 def __parseAuthHeader(string):
   """
@@ -30,4 +102,4 @@ def __parseAuthHeader(string):
   if len(components) != 2:
     raise ValueError('Invalid authorization header.')
 
-  return components[1]
\ No newline at end of file
+  return components[1]
@@ -0,0 +1,212 @@
+import os
+import select
+import threading
+import time
+
+import psycopg2
+import psycopg2.extensions
+from sqlalchemy import event, text
+
+"""
+Per-worker caches with cross-worker invalidation
+
+Every gunicorn worker keeps its own copy of rarely-changing rows (active
+matching algorithms, the online mode flag, ...). Whoever changes one of them
+calls `notify(session, topic)` inside the same transaction; Postgres delivers
+the NOTIFY to every worker's ChangeListener on commit, which clears the
+caches subscribed to that topic. Entries also expire after a short TTL, so a
+worker whose listener connection dropped is never stale for long.
+
+Caches can also depend on tables: with track_table_changes, every table
+written through the ORM that some cache depends on publishes the topic
+'table:<name>' automatically.
+"""
+
+CHANNEL = 'duo_cache'
+
+_MISSING = object()
+
+
+class ChangeListener(object):
+  def __init__(self, channel=CHANNEL):
+    self.channel = channel
+    self.dsn = None
+    self.default_ttl = 30
+    self._handlers = {}
+    self._thread = None
+    self._pid = None
+    self._lock = threading.Lock()
+
+  def init_app(self, app):
+    self.dsn = app.config['SQLALCHEMY_DATABASE_URI']
+    self.default_ttl = app.config.get('CACHE_TTL', self.default_ttl)
+
+  def subscribe(self, topic, handler):
+    self._handlers.setdefault(topic, []).append(handler)
+
+  def ensure_started(self):
+    # Started lazily so that each gunicorn worker listens on its own connection
+    if self.dsn is None or (self._thread is not None and self._pid == os.getpid()):
+      return
+
+    with self._lock:
+      if self._thread is not None and self._pid == os.getpid():
+        return
+
+      self._pid = os.getpid()
+      self._thread = threading.Thread(target=self._run, name='cache-listener', daemon=True)
+      self._thread.start()
+
+  def has_subscribers(self, topic):
+    return len(self._handlers.get(topic, [])) > 0
+
+  def dispatch(self, topic):
+    for handler in self._handlers.get(topic, []):
+      handler()
+
+  def dispatch_all(self):
+    for topic in list(self._handlers):
+      self.dispatch(topic)
+
+  def _run(self):
+    while True:
+      conn = None
+      try:
+        conn = psycopg2.connect(self.dsn)
+        conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        conn.cursor().execute('LISTEN %s' % self.channel)
+
+        # Anything could have changed while we weren't listening
+        self.dispatch_all()
+        self._listen(conn)
+      except Exception as e:
+        print('Cache listener disconnected: %s' % e)
+        time.sleep(5)
+      finally:
+        if conn is not None:
+          conn.close()
+
+  def _listen(self, conn):
+    while True:
+      if select.select([conn], [], [], 60) == ([], [], []):
+        continue
+
+      conn.poll()
+      while conn.notifies:
+        self.dispatch(conn.notifies.pop(0).payload)
+
+
+change_listener = ChangeListener()
+
+
+def notify(session, topic):
+  """
+  Tells every worker (this one included) to drop its caches for 'topic' once
+  the session's transaction commits
+  """
+  session.execute('select pg_notify(:channel, :topic)', {'channel': CHANNEL, 'topic': topic})
+
+
+def table_topic(table):
+  return 'table:%s' % table
+
+
+# Tables whose writes also bump their row in table_version (see versioned)
+versioned_tables = set()
+
+
+def versioned(tables):
+  versioned_tables.update(tables)
+
+
+def notify_tables(session, tables, listener=change_listener):
+  """
+  Like notify, for the topics of tables written without the ORM (raw SQL
+  updates, bulk inserts, ...). Each table is only announced once per
+  transaction, and only if something caches it or it's versioned.
+  """
+  changed = session.info.setdefault('changed_tables', set())
+  tables = [
+    t for t in set(tables) - changed
+    if t in versioned_tables or listener.has_subscribers(table_topic(t))
+  ]
+  for table in sorted(tables):
+    changed.add(table)
+    connection = session.connection()
+
+    if table in versioned_tables:
+      connection.execute(text("""
+        insert into table_version (table_name, version) values (:table, 1)
+        on conflict (table_name) do update set version = table_version.version + 1
+      """), table=table)
+
+    if listener.has_subscribers(table_topic(table)):
+      connection.execute(
+        text('select pg_notify(:channel, :topic)'),
+        channel=CHANNEL,
+        topic=table_topic(table)
+      )
+
+
+def track_table_changes(session, listener=change_listener):
+  """
+  Publishes the topic of every cached table the ORM writes to in a
+  transaction, and clears this worker's caches for them as soon as it commits
+  """
+  @event.listens_for(session, 'after_flush')
+  def after_flush(session, flush_context):
+    tables = set()
+    for obj in list(session.new) + list(session.deleted):
+      tables.add(obj.__table__.name)
+    for obj in session.dirty:
+      if session.is_modified(obj):
+        tables.add(obj.__table__.name)
+
+    notify_tables(session, tables, listener)
+
+  @event.listens_for(session, 'after_commit')
+  def after_commit(session):
+    for table in session.info.pop('changed_tables', []):
+      listener.dispatch(table_topic(table))
+
+  @event.listens_for(session, 'after_rollback')
+  def after_rollback(session):
+    session.info.pop('changed_tables', None)
+
+
+class InvalidatingCache(object):
+  def __init__(self, topic, ttl=None, listener=change_listener, tables=None):
+    """
+    The cache is cleared when 'topic' or a change to any of 'tables' is
+    published
+    """
+    self.topic = topic
+    self.ttl = ttl
+    self._listener = listener
+    self._entries = {}
+    self._generation = 0
+    listener.subscribe(topic, self.clear)
+    for table in tables or []:
+      listener.subscribe(table_topic(table), self.clear)
+
+  def get(self, key, load):
+    """
+    Returns the cached value for 'key', calling load(key) on a miss
+    """
+    self._listener.ensure_started()
+
+    value, expires_at = self._entries.get(key, (_MISSING, 0))
+    if value is _MISSING or time.time() >= expires_at:
+      ttl = self.ttl if self.ttl is not None else self._listener.default_ttl
+      generation = self._generation
+      value = load(key)
+
+      # Don't keep a value that was invalidated while we were loading it
+      if generation == self._generation:
+        self._entries[key] = (value, time.time() + ttl)
+
+    return value
+
+  def clear(self):
+    self._generation += 1
+    self._entries = {}
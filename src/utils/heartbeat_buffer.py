@@ -0,0 +1,160 @@
+import atexit
+import datetime
+import os
+import threading
+import time
+
+from sqlalchemy.exc import DataError, IntegrityError
+
+"""
+Heartbeat write-behind buffer
+
+Every student pings /students/<id>/heartbeat every few seconds. Rather than
+writing each ping, repeated pings for the same (student_id, device_id, skill)
+are merged in memory and handed to `flush` in batches, either every
+`interval` seconds or as soon as `max_size` distinct heartbeats are waiting.
+The buffer is drained on a clean shutdown.
+
+A batch rejected for its data (say, a heartbeat of a student deleted in the
+meantime) is retried row by row so the others still land. Any other failure,
+like a lost database connection, puts the whole batch back and backs off
+exponentially up to `max_backoff` seconds. While the buffer holds
+`max_size * 10` heartbeats, pings from students not already in it are
+dropped.
+"""
+
+class HeartbeatBuffer(object):
+  def __init__(self, flush, interval=5, max_size=500, max_attempts=5, max_backoff=60):
+    """
+    'flush' is called (from the buffer's own thread, or at exit) with a list
+    of dicts: student_id, device_id, skill, first_seen, last_seen. A
+    heartbeat rejected on its own 'max_attempts' times is dropped.
+    """
+    self._flush = flush
+    self.interval = interval
+    self.max_size = max_size
+    self.max_attempts = max_attempts
+    self.max_backoff = max_backoff
+    self._delay = interval
+    self._retry_at = 0
+    self._entries = {}
+    self._lock = threading.Lock()
+    self._wakeup = threading.Event()
+    self._thread = None
+    self._pid = None
+    atexit.register(self.flush)
+
+  def add(self, student_id, device_id, skill):
+    now = datetime.datetime.utcnow()
+    key = (student_id, device_id, skill)
+
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is None:
+        entry = {
+          'student_id': student_id,
+          'device_id': device_id,
+          'skill': skill,
+          'first_seen': now,
+          'last_seen': now
+        }
+        # When the database has been unreachable for a while the ping is
+        # still answered, just not written
+        if len(self._entries) < self._capacity():
+          self._entries[key] = entry
+      else:
+        entry['last_seen'] = now
+
+      size = len(self._entries)
+      data = dict(entry)
+
+    self._ensure_started()
+    if size >= self.max_size:
+      self._wakeup.set()
+
+    return data
+
+  def flush(self):
+    with self._lock:
+      entries = list(self._entries.values())
+      self._entries = {}
+
+    if len(entries) == 0:
+      return
+
+    try:
+      self._flush(entries)
+    except (IntegrityError, DataError) as e:
+      print('Failed to flush %d heartbeats: %s' % (len(entries), e))
+      if len(entries) > 1:
+        entries = self._flush_each(entries)
+      self._requeue(entries, count_attempt=True)
+    except Exception as e:
+      print('Failed to flush %d heartbeats, retrying in %ds: %s' % (len(entries), self._delay, e))
+      self._retry_at = time.time() + self._delay
+      self._delay = min(self._delay * 2, self.max_backoff)
+      self._requeue(entries, count_attempt=False)
+      return
+
+    # The database is reachable again
+    self._delay = self.interval
+    self._retry_at = 0
+
+  def _flush_each(self, entries):
+    # Only for batches rejected for their data: retry one by one so the good
+    # heartbeats still land. Returns the ones that failed again.
+    failed = []
+    for entry in entries:
+      try:
+        self._flush([entry])
+      except (IntegrityError, DataError):
+        failed.append(entry)
+      except Exception:
+        # Lost the database halfway; put back everything not yet written
+        failed.extend(entries[entries.index(entry):])
+        break
+    return failed
+
+  def _requeue(self, entries, count_attempt):
+    with self._lock:
+      for entry in entries:
+        if count_attempt:
+          entry['attempts'] = entry.get('attempts', 0) + 1
+          if entry['attempts'] >= self.max_attempts:
+            print('Dropping heartbeat after %d failed flushes: %s' % (entry['attempts'], entry))
+            continue
+
+        key = (entry['student_id'], entry['device_id'], entry['skill'])
+        newer = self._entries.get(key)
+        if newer is None:
+          # Don't let an unreachable database grow the buffer without bound
+          if len(self._entries) < self._capacity():
+            self._entries[key] = entry
+        else:
+          newer['first_seen'] = min(newer['first_seen'], entry['first_seen'])
+          newer['attempts'] = max(newer.get('attempts', 0), entry.get('attempts', 0))
+
+  def _capacity(self):
+    return self.max_size * 10
+
+  def _ensure_started(self):
+    # The thread is started lazily so each gunicorn worker gets its own
+    if self._thread is not None and self._pid == os.getpid():
+      return
+
+    with self._lock:
+      if self._thread is not None and self._pid == os.getpid():
+        return
+
+      self._pid = os.getpid()
+      self._thread = threading.Thread(target=self._run, name='heartbeat-buffer', daemon=True)
+      self._thread.start()
+
+  def _run(self):
+    while True:
+      self._wakeup.wait(self.interval)
+      self._wakeup.clear()
+
+      # A full buffer doesn't cut a backoff short
+      if time.time() >= self._retry_at:
+        self.flush()
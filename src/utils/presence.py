@@ -0,0 +1,129 @@
+import datetime
+import threading
+import time
+
+"""
+Presence index
+
+Who is online right now, and on what skill, keyed by class section and skill.
+Each student's most recent heartbeat is fed in by the heartbeat endpoint and
+expires after `ttl` seconds. Since every gunicorn worker only sees the
+heartbeats it served itself, the index also merges in recent rows from
+student_heartbeat (through `loader`) when it's first used and then at most
+every `refresh_interval` seconds. Expired students are pruned at the same
+time, so the index only ever holds students seen within the TTL.
+"""
+
+class PresenceIndex(object):
+  def __init__(self, loader, ttl=60, refresh_interval=15):
+    """
+    'loader(since)' returns the latest heartbeat per student since the given
+    datetime, as rows with student_id, class_section_id, device_id, skill and
+    last_updated
+    """
+    self._loader = loader
+    self.ttl = ttl
+    self.refresh_interval = refresh_interval
+    self._by_student = {}
+    self._by_class = {}
+    self._loaded_at = None
+    self._pruned_at = 0
+    self._lock = threading.RLock()
+
+  def record(self, student_id, class_section_id, device_id, skill, last_seen):
+    with self._lock:
+      prev = self._by_student.get(student_id)
+      if prev is not None:
+        if prev['last_seen'] > last_seen:
+          return
+        self._remove(prev)
+
+      # Heartbeats alone keep the index bounded, even if nobody reads it
+      if time.time() - self._pruned_at >= self.refresh_interval:
+        self._prune()
+
+      entry = {
+        'student_id': student_id,
+        'class_section_id': class_section_id,
+        'device_id': device_id,
+        'skill': skill,
+        'last_seen': last_seen
+      }
+      self._by_student[student_id] = entry
+      self._by_class.setdefault(class_section_id, {}) \
+        .setdefault(skill, {})[student_id] = entry
+
+  def class_for(self, student_id):
+    """
+    The class section of a student seen within the TTL, or None
+    """
+    entry = self._by_student.get(student_id)
+    if entry is None or entry['last_seen'] < self._cutoff():
+      return None
+    return entry['class_section_id']
+
+  def online(self, class_section_id, skill=None):
+    """
+    The students of a class seen within the TTL (on a given skill, if any)
+    """
+    self._refresh()
+    cutoff = self._cutoff()
+
+    with self._lock:
+      skills = self._by_class.get(class_section_id, {})
+      if skill is not None:
+        buckets = [skills.get(skill, {})]
+      else:
+        buckets = list(skills.values())
+
+      entries = []
+      for bucket in buckets:
+        for entry in list(bucket.values()):
+          if entry['last_seen'] < cutoff:
+            self._remove(entry)
+          else:
+            entries.append(dict(entry))
+
+      return entries
+
+  def _refresh(self):
+    now = time.time()
+    if self._loaded_at is not None and now - self._loaded_at < self.refresh_interval:
+      return
+
+    with self._lock:
+      if self._loaded_at is not None and now - self._loaded_at < self.refresh_interval:
+        return
+      self._loaded_at = now
+
+      self._prune()
+      try:
+        rows = self._loader(self._cutoff())
+      except Exception as e:
+        print('Failed to load presence: %s' % e)
+        return
+
+      for r in rows:
+        self.record(r['student_id'], r['class_section_id'], r['device_id'], r['skill'], r['last_updated'])
+
+  def _prune(self):
+    self._pruned_at = time.time()
+    cutoff = self._cutoff()
+    for entry in list(self._by_student.values()):
+      if entry['last_seen'] < cutoff:
+        self._remove(entry)
+
+  def _remove(self, entry):
+    skills = self._by_class.get(entry['class_section_id'], {})
+    bucket = skills.get(entry['skill'], {})
+    bucket.pop(entry['student_id'], None)
+    if len(bucket) == 0:
+      skills.pop(entry['skill'], None)
+    if len(skills) == 0:
+      self._by_class.pop(entry['class_section_id'], None)
+
+    if self._by_student.get(entry['student_id']) is entry:
+      del self._by_student[entry['student_id']]
+
+  def _cutoff(self):
+    return datetime.datetime.utcnow() - datetime.timedelta(seconds=self.ttl)
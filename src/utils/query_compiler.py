@@ -0,0 +1,125 @@
+import re
+import threading
+
+from sqlalchemy import text
+
+"""
+Compiled matching algorithm queries
+
+Matching algorithms are written with printf-style placeholders ('%s', %s,
+%d), which used to be filled in with `sql_query % tuple(args)`. That let
+request arguments inject SQL and sent new SQL text on every call. Instead,
+each query is compiled once into a text() statement whose placeholders are
+bound parameters (:arg0, :arg1, ...), and kept per algorithm ID and version.
+Placeholders inside longer string literals (like '%%%s%%') are concatenated
+into the literal, so the same SQL keeps working.
+"""
+
+# String literals, with '' as an escaped quote
+LITERAL = re.compile(r"'(?:[^']|'')*'")
+
+# Placeholders, plus '%%' for a literal percent sign
+PLACEHOLDER = re.compile(r'%([sd%])')
+
+# Colons that text() would otherwise read as bind parameters (but not casts)
+BARE_COLON = re.compile(r'(?<![:\w\\]):(?=\w)')
+
+
+class CompiledQuery(object):
+  def __init__(self, sql_query):
+    self.converters = []
+    sql = BARE_COLON.sub(r'\\:', sql_query)
+
+    # Placeholders outside literals become binds; literals are rewritten on
+    # their own (see _literal)
+    parts = []
+    position = 0
+    for match in LITERAL.finditer(sql):
+      parts.append(PLACEHOLDER.sub(self._placeholder, sql[position:match.start()]))
+      parts.append(self._literal(match.group(0)))
+      position = match.end()
+    parts.append(PLACEHOLDER.sub(self._placeholder, sql[position:]))
+
+    self.sql = ''.join(parts)
+    self.statement = text(self.sql)
+
+  def params(self, args):
+    if len(args) != len(self.converters):
+      raise ValueError('Expected %d arguments but got %d' % (len(self.converters), len(args)))
+
+    return {
+      'arg%d' % i: convert(arg) if arg is not None else None
+      for i, (convert, arg) in enumerate(zip(self.converters, args))
+    }
+
+  def explain_statement(self, options='ANALYZE, BUFFERS, FORMAT JSON'):
+    return text('EXPLAIN (%s) %s' % (options, self.sql))
+
+  def _placeholder(self, match):
+    kind = match.group(1)
+    if kind == '%':
+      return '%'
+
+    self.converters.append(int if kind == 'd' else _identity)
+    return self._bind()
+
+  def _literal(self, literal):
+    """
+    '%s' and '%d' are whole-value placeholders. Placeholders embedded in a
+    longer literal, as in like '%%%s%%', are spliced in with || so the bound
+    value ends up inside the string: ('%' || :arg0 || '%').
+    """
+    if literal in ("'%s'", "'%d'"):
+      self.converters.append(int if literal == "'%d'" else str)
+      return self._bind()
+
+    pieces = []
+    chunk = ''
+    for i, part in enumerate(PLACEHOLDER.split(literal[1:-1])):
+      if i % 2 == 0:
+        chunk += part
+      elif part == '%':
+        chunk += '%'
+      else:
+        if chunk != '':
+          pieces.append("'%s'" % chunk)
+          chunk = ''
+        self.converters.append(_int_string if part == 'd' else str)
+        pieces.append(self._bind())
+
+    if len(pieces) == 0:
+      return "'%s'" % chunk
+    if chunk != '':
+      pieces.append("'%s'" % chunk)
+    return '(%s)' % ' || '.join(pieces)
+
+  def _bind(self):
+    return ':arg%d' % (len(self.converters) - 1)
+
+
+_compiled = {}
+_lock = threading.Lock()
+
+
+def compile_query(algorithm_id, version, sql_query):
+  key = (algorithm_id, version)
+  compiled = _compiled.get(key)
+  if compiled is None:
+    compiled = CompiledQuery(sql_query)
+    with _lock:
+      _compiled[key] = compiled
+  return compiled
+
+
+def invalidate(algorithm_id):
+  with _lock:
+    for key in [k for k in _compiled if k[0] == algorithm_id]:
+      del _compiled[key]
+
+
+def _identity(value):
+  return value
+
+
+def _int_string(value):
+  return str(int(value))
@@ -0,0 +1,115 @@
+import math
+import time
+
+from sqlalchemy import text
+
+"""
+Matching algorithm profiler
+
+Runs an algorithm's compiled query (see query_compiler) for a set of argument
+lists and reports latency percentiles, rows returned and the plan from
+EXPLAIN (ANALYZE, BUFFERS), flagging sequential scans over large tables.
+Everything runs on the connection handed in, which should be the algorithm's
+sandbox (read-only, rolled back and under its statement_timeout), and stops
+early once the whole benchmark has taken `timeout` seconds.
+"""
+
+# Sequential scans over tables with at least this many (estimated) rows are flagged
+LARGE_TABLE_ROWS = 10000
+
+# Upper bound on a whole benchmark, on top of each statement's own timeout
+BENCHMARK_TIMEOUT = 30
+
+
+def profile(connection, compiled, arg_lists, runs=10, max_rows=1000, timeout=BENCHMARK_TIMEOUT):
+  """
+  Executes the query up to 'runs' times for each list of arguments in
+  'arg_lists', reading at most max_rows + 1 rows each time
+  """
+  if len(arg_lists) == 0:
+    raise ValueError('Must provide at least one student to run the algorithm for')
+
+  timings = []
+  row_counts = []
+  deadline = time.perf_counter() + timeout
+  timed_out = False
+
+  for _ in range(runs):
+    for args in arg_lists:
+      if time.perf_counter() >= deadline:
+        timed_out = True
+        break
+
+      start = time.perf_counter()
+      result = connection \
+        .execution_options(stream_results=True) \
+        .execute(compiled.statement, compiled.params(args))
+      rows = result.fetchmany(max_rows + 1)
+      result.close()
+      timings.append((time.perf_counter() - start) * 1000)
+      row_counts.append(len(rows))
+
+    if timed_out:
+      break
+
+  plan = connection.execute(compiled.explain_statement(), compiled.params(arg_lists[0])).scalar()
+  plan = plan[0] if isinstance(plan, list) else plan
+
+  timings.sort()
+  return {
+    'executions': len(timings),
+    'timed_out': timed_out,
+    'latency_ms': {
+      'p50': _percentile(timings, 50),
+      'p95': _percentile(timings, 95),
+      'p99': _percentile(timings, 99),
+      'max': timings[-1]
+    },
+    'rows': {
+      'min': min(row_counts),
+      'max': max(row_counts),
+      'mean': sum(row_counts) / len(row_counts),
+      'over_max_rows': len([c for c in row_counts if c > max_rows])
+    },
+    'plan': plan,
+    'seq_scans': large_seq_scans(connection, plan)
+  }
+
+
+def large_seq_scans(connection, plan, min_rows=LARGE_TABLE_ROWS):
+  """
+  The sequential scans in an EXPLAIN (FORMAT JSON) plan whose table holds at
+  least 'min_rows' rows according to the planner's statistics
+  """
+  scans = [node for node in _nodes(plan.get('Plan', plan)) if node.get('Node Type') == 'Seq Scan']
+  if len(scans) == 0:
+    return []
+
+  relations = list(set(node['Relation Name'] for node in scans))
+  sizes = dict(connection.execute(
+    text('select relname, reltuples from pg_class where relname = any(:relations)'),
+    relations=relations
+  ).fetchall())
+
+  return [
+    {
+      'relation': node['Relation Name'],
+      'table_rows': int(sizes.get(node['Relation Name'], 0)),
+      'rows_removed_by_filter': node.get('Rows Removed by Filter'),
+      'filter': node.get('Filter')
+    }
+    for node in scans
+    if sizes.get(node['Relation Name'], 0) >= min_rows
+  ]
+
+
+def _nodes(node):
+  yield node
+  for child in node.get('Plans', []):
+    yield from _nodes(child)
+
+
+def _percentile(sorted_values, p):
+  # Nearest-rank
+  index = max(0, math.ceil(p / 100 * len(sorted_values)) - 1)
+  return sorted_values[index]
@@ -0,0 +1,178 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from urllib.request import urlopen
+
+import firebase_admin
+from google.auth import jwt
+
+"""
+Local Firebase ID token verification
+
+firebase_admin.auth.verify_id_token checks the signature on every call and
+re-fetches Google's public certificates whenever its HTTP cache is cold, which
+happens on every fresh gunicorn worker. Here the certificates live in a
+process-wide KeyStore that refreshes itself once their max-age runs out, and
+decoded tokens are kept in an LRU (keyed by a hash of the token) until the
+token's own 'exp'.
+
+Set FIREBASE_CERTS_URL to load the keys from elsewhere, e.g. a local fixture:
+  FIREBASE_CERTS_URL=file:///path/to/certs.json
+"""
+
+ID_TOKEN_CERT_URI = ('https://www.googleapis.com/robot/v1/metadata/x509/'
+                     'securetoken@system.gserviceaccount.com')
+ID_TOKEN_ISSUER_PREFIX = 'https://securetoken.google.com/'
+
+DEFAULT_KEY_TTL = 60 * 60
+MIN_REFRESH_INTERVAL = 30
+TOKEN_CACHE_SIZE = 4096
+
+
+class KeyStore(object):
+  """
+  Google's public signing certificates (key ID => PEM certificate)
+  """
+  def __init__(self, url):
+    self.url = url
+    self._keys = {}
+    self._expires_at = 0
+    self._fetched_at = 0
+    self._lock = threading.Lock()
+
+  def get(self, kid):
+    keys = self._keys
+    if time.time() >= self._expires_at or kid not in keys:
+      keys = self.refresh()
+    return keys.get(kid)
+
+  def refresh(self, force=False):
+    with self._lock:
+      now = time.time()
+      # Another thread may have refreshed while we were waiting; unknown key
+      # IDs shouldn't let a bad token make us hammer the cert endpoint either
+      fresh = now < self._expires_at and now - self._fetched_at < MIN_REFRESH_INTERVAL
+      if fresh and not force:
+        return self._keys
+
+      with urlopen(self.url, timeout=10) as response:
+        keys = json.loads(response.read().decode('utf-8'))
+        max_age = _parse_max_age(response.headers.get('Cache-Control'))
+
+      self._keys = keys
+      self._fetched_at = now
+      self._expires_at = now + (max_age if max_age is not None else DEFAULT_KEY_TTL)
+      return keys
+
+  def set_url(self, url):
+    with self._lock:
+      self.url = url
+      self._keys = {}
+      self._expires_at = 0
+      self._fetched_at = 0
+
+
+class TokenCache(object):
+  """
+  LRU of decoded token claims; entries are dropped once the token expires
+  """
+  def __init__(self, max_size=TOKEN_CACHE_SIZE):
+    self.max_size = max_size
+    self._entries = OrderedDict()
+    self._lock = threading.Lock()
+
+  def get(self, key):
+    with self._lock:
+      claims = self._entries.get(key)
+      if claims is None:
+        return None
+
+      if claims['exp'] <= time.time():
+        del self._entries[key]
+        return None
+
+      self._entries.move_to_end(key)
+      return claims
+
+  def put(self, key, claims):
+    with self._lock:
+      self._entries[key] = claims
+      self._entries.move_to_end(key)
+      while len(self._entries) > self.max_size:
+        self._entries.popitem(last=False)
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+
+
+key_store = KeyStore(os.environ.get('FIREBASE_CERTS_URL', ID_TOKEN_CERT_URI))
+token_cache = TokenCache()
+
+
+def verify_id_token(token):
+  """
+  Drop-in replacement for firebase_admin.auth.verify_id_token (without
+  revocation checks). Returns the decoded claims; raises ValueError if the
+  token is invalid or expired.
+  """
+  if not token:
+    raise ValueError('Must provide an ID token.')
+
+  key = hashlib.sha256(token.encode('utf-8')).hexdigest()
+  claims = token_cache.get(key)
+  if claims is not None:
+    return claims
+
+  claims = _decode(token)
+  token_cache.put(key, claims)
+  return claims
+
+
+def _decode(token):
+  project_id = _project_id()
+  if not project_id:
+    raise ValueError('Could not determine the Firebase project ID.')
+
+  header = jwt.decode_header(token)
+  if header.get('alg') != 'RS256':
+    raise ValueError('ID token has incorrect algorithm.')
+
+  kid = header.get('kid')
+  if not kid:
+    raise ValueError('ID token has no "kid" claim.')
+
+  cert = key_store.get(kid)
+  if cert is None:
+    raise ValueError('ID token was signed with an unknown key.')
+
+  # Checks the signature, 'iat', 'exp' and 'aud'
+  claims = jwt.decode(token, certs=cert, audience=project_id)
+
+  if claims.get('iss') != ID_TOKEN_ISSUER_PREFIX + project_id:
+    raise ValueError('ID token has incorrect "iss" (issuer) claim.')
+
+  subject = claims.get('sub')
+  if not isinstance(subject, str) or not subject or len(subject) > 128:
+    raise ValueError('ID token has an invalid "sub" (subject) claim.')
+
+  claims['uid'] = subject
+  return claims
+
+
+def _project_id():
+  project_id = os.environ.get('FIREBASE_PROJECT_ID')
+  if project_id:
+    return project_id
+  return firebase_admin.get_app().project_id
+
+
+def _parse_max_age(cache_control):
+  if cache_control is None:
+    return None
+  match = re.search(r'max-age=(\d+)', cache_control)
+  return int(match.group(1)) if match else None